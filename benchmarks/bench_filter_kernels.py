@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+##################################################
+## Microbenchmark of the grouped kernels used by the NLP filters in nlp_filter.py (per-patient percentile,
+## clade mean frequency, and dense clade rank), comparing the original per-group lambda transforms with the
+## native grouped rank/size operations and the sort-based group_mean kernel on synthetic cohorts.
+## Results of both implementations are checked for exact equality.
+##
+## python3.8 benchmarks/bench_filter_kernels.py [n_patients ...]   (defaults to 1000 10000 100000)
+##################################################
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from nlp_filter import group_mean
+
+
+#synthetic clade-expanded term table: ~20 terms per patient, 1-3 clades per term out of 23 root phenotypes
+def make_terms(n_patients, seed=0):
+	rng = np.random.default_rng(seed)
+	terms_per_patient = rng.integers(1, 40, n_patients)
+	patients = np.repeat(np.arange(n_patients), terms_per_patient)
+	frequencies = rng.choice([1, 1, 1, 2, 2, 3, 4, 5, 8, 12, 16, 32], len(patients))
+	clades_per_term = rng.integers(1, 4, len(patients))
+	rows = np.repeat(np.arange(len(patients)), clades_per_term)
+	return(pd.DataFrame({"Patient": pd.Series(patients[rows]).map("MAN_{:06d}-01".format), "Frequency": frequencies[rows], "root_phenos_2": rng.integers(0, 23, len(rows)).astype(str)}))
+
+
+def legacy_kernels(data):
+	percentile = data.groupby("Patient").Frequency.transform(lambda x: x.rank() / len(x))
+	clade_frequency = data.assign(percentile=percentile).groupby(["Patient", "root_phenos_2"]).percentile.transform(lambda x: x.mean())
+	clade_frequency_rank = data.assign(clade_frequency=clade_frequency).groupby(["Patient"]).clade_frequency.transform(lambda x: x.rank(ascending=False, method="dense"))
+	return(percentile, clade_frequency, clade_frequency_rank)
+
+
+def native_kernels(data):
+	patient_frequency = data.groupby("Patient").Frequency
+	percentile = patient_frequency.rank() / patient_frequency.transform("size")
+	clade_frequency = pd.Series(group_mean(data.groupby(["Patient", "root_phenos_2"], sort=False).ngroup().values, percentile.values), index=data.index)
+	clade_frequency_rank = data.assign(clade_frequency=clade_frequency).groupby("Patient").clade_frequency.rank(ascending=False, method="dense")
+	return(percentile, clade_frequency, clade_frequency_rank)
+
+
+def timed(func, data):
+	start = time.perf_counter()
+	result = func(data)
+	return(time.perf_counter() - start, result)
+
+
+sizes = [int(x) for x in sys.argv[1:]] if len(sys.argv) > 1 else [1000, 10000, 100000]
+
+print("{:>10} {:>10} {:>12} {:>12} {:>9}".format("patients", "rows", "lambda (s)", "native (s)", "speedup"))
+for n_patients in sizes:
+	data = make_terms(n_patients)
+	legacy_time, legacy_result = timed(legacy_kernels, data)
+	native_time, native_result = timed(native_kernels, data)
+	for legacy, native in zip(legacy_result, native_result):
+		assert np.array_equal(legacy.values, native.values), "native kernels differ from lambda transforms"
+	print("{:>10} {:>10} {:>12.3f} {:>12.3f} {:>8.1f}x".format(n_patients, len(data), legacy_time, native_time, legacy_time / native_time))
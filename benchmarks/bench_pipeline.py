@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+##################################################
+## Offline benchmark of the pipeline on synthetic cohorts (benchmarks/synthetic_data.py), with S3 replaced by the
+## local object store in local_object_store.py. For each cohort size it reports per-stage wall time, peak memory (RSS)
+## and throughput of:
+## fetch          concurrent fetch of the per-patient Clinithink CSVs and writing the combined file
+## upload         upload of the combined file (and again once it is unchanged)
+## hpo_index      download of the HPO tables and build of the binary HPO index
+## read_terms     parse of the combined file
+## prepare_terms  percentiles and HPO index join
+## sweep_text     every run of the grid written as Clinithink-format files, for each grid size and number of workers
+## sweep_bitmask  every run of the grid written as a single bitmask file, for each grid size and number of workers
+## post_process_NLP.py   the whole script (paper grid of 294 runs) as a subprocess
+## run_exomiser_job.py   exomiser jobs (as run by each ray_parallel_nlp.py task, without docker) as subprocesses, with a
+##                       stand-in java on the PATH that writes results instead of running Exomiser
+## exomiser_workers      the same jobs run by long-lived run_exomiser_job.py workers taking them from a job queue (job_queue.py)
+## Results can be appended to a JSON lines file and compared with an earlier results file (--baseline), in which case
+## the script exits with status 1 if any stage is slower than --tolerance times its baseline.
+##
+## python3.8 benchmarks/bench_pipeline.py --patients 100 1000 10000 --grid 42 294 --workers 1 8 64 --output bench_pipeline.jsonl
+##################################################
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import concurrent.futures
+from datetime import date
+import yaml
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+import nlp_filter
+from nlp_filter import read_terms, prepare_terms, compute_runs, write_bitmask, get_bitmask_filename
+from clinithink_format import write_formatted_blocks
+from hpo_index import get_hpo_index
+from local_object_store import LocalS3Client
+from pipeline_metrics import MemorySampler
+from s3_transfer import fetch_objects, upload_changed_files
+from job_queue import create_queue, enqueue_jobs, close_queue, get_done_jobs
+from synthetic_data import make_cohort, make_run_grid
+
+bucket = "bench"
+
+#stands in for "java -jar exomiser-cli ... --analysis <yml>" (or --analysis-batch <file of ymls>): writes a result json/html with one gene per HPO term
+fake_java = """#!{python}
+import sys, json, time, yaml
+if "--analysis" in sys.argv:
+	analysis_files = [sys.argv[sys.argv.index("--analysis") + 1]]
+else:
+	with open(sys.argv[sys.argv.index("--analysis-batch") + 1]) as fh:
+		analysis_files = fh.read().split()
+for analysis_file in analysis_files:
+	with open(analysis_file) as fh:
+		analysis = yaml.safe_load(fh)
+	time.sleep({runtime})
+	output_prefix = analysis["outputOptions"]["outputPrefix"]
+	with open(output_prefix + ".json", "w") as fhw:
+		json.dump([{{"geneSymbol": "GENE{{}}".format(i), "combinedScore": 1 / (i + 1), "variantScore": 0.5, "priorityScore": 1 / (i + 1)}} for i in range(len(analysis["analysis"]["hpoIds"]))], fhw)
+	with open(output_prefix + ".html", "w") as fhw:
+		fhw.write("<html></html>")
+"""
+
+
+def report(results, context, stage, seconds, peak_rss_bytes, count, unit):
+	record = dict(context, stage=stage, seconds=round(seconds, 4), peak_rss_mb=round(peak_rss_bytes / 2**20, 1), throughput=round(count / max(seconds, 1e-9), 1), unit=unit)
+	results.append(record)
+	print("{:>9} {:>5} {:<22} {:>9.3f} {:>10.1f} {:>12.1f} {}".format(record["patients"], record["grid"] or "", stage, seconds, record["peak_rss_mb"], record["throughput"], unit))
+
+
+#time func() in this process; count is the amount of work done (or a function of func's result)
+def run_stage(results, context, stage, func, count, unit):
+	with MemorySampler() as memory:
+		start = time.perf_counter()
+		value = func()
+		seconds = time.perf_counter() - start
+	report(results, context, stage, seconds, memory.peak, count(value) if callable(count) else count, unit)
+	return(value)
+
+
+#run a command to completion; returns (wall time, peak RSS in bytes of the process)
+def run_process(args, env, cwd):
+	start = time.perf_counter()
+	process = subprocess.Popen(args, env=env, cwd=cwd, stdout=subprocess.DEVNULL)
+	pid, status, rusage = os.wait4(process.pid, 0)
+	seconds = time.perf_counter() - start
+	if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+		raise RuntimeError("{} failed with wait status {}".format(" ".join(args), status))
+	return(seconds, rusage.ru_maxrss * 1024)
+
+
+def bench_cohort(results, n_patients, grid_sizes, args, bench_dir):
+	context = {"date": str(date.today()), "commit": args.commit, "patients": n_patients, "grid": None, "latency": args.latency}
+	store_dir = os.path.join(bench_dir, "s3")
+	workdir = os.path.join(bench_dir, "workdir")
+	os.makedirs(workdir)
+	client = LocalS3Client(store_dir, latency=args.latency)
+	vcf_files = make_cohort(client, bucket, n_patients, n_terms=args.terms, seed=args.seed)
+
+	#the stages below follow post_process_NLP.py, in its working directory
+	os.chdir(workdir)
+	key_map = dict(zip(["Clinithink_raw/" + re.match("s3.+MAN_(\d+-01).+\.vcf", vcf_file).groups()[0] + ".csv" for vcf_file in vcf_files], [re.match("s3.+(MAN_.+)\.vcf", vcf_file).groups()[0] for vcf_file in vcf_files]))
+
+	def fetch():
+		num_bytes = 0
+		with open("NLPoutput.txt", "w") as fhw:
+			for key, body in fetch_objects(client, bucket, key_map.keys(), concurrency=args.concurrency):
+				num_bytes += len(body)
+				fhw.write("{}\n{}".format(key_map[key], re.sub("\nHP", "\nhp", body.decode())))
+		return(num_bytes)
+
+	run_stage(results, context, "fetch", fetch, n_patients, "objects/s")
+	run_stage(results, context, "upload", lambda: upload_changed_files(client, bucket, {"NLPoutput.txt": "NLPoutput.txt"}, "s3_upload_manifest.json", concurrency=args.concurrency), 1, "files/s")
+	run_stage(results, context, "upload (unchanged)", lambda: upload_changed_files(client, bucket, {"NLPoutput.txt": "NLPoutput.txt"}, "s3_upload_manifest.json", concurrency=args.concurrency), 1, "files/s")
+
+	def build_index():
+		client.download_file(bucket, "hpo_multishortest_paths_stats.csv", nlp_filter.clade_depth_file)
+		client.download_file(bucket, "hpo_multishortest_paths.csv", nlp_filter.clades_list_file)
+		return(get_hpo_index(nlp_filter.clade_depth_file, nlp_filter.clades_list_file, nlp_filter.hpo_index_dir))
+
+	hpo_index = run_stage(results, context, "hpo_index", build_index, lambda hpo_index: len(hpo_index["hpo_ids"]), "terms/s")
+	data = run_stage(results, context, "read_terms", lambda: read_terms("NLPoutput.txt"), len, "rows/s")
+	all_terms, clade_data = run_stage(results, context, "prepare_terms", lambda: prepare_terms(data, hpo_index), len(data), "rows/s")
+
+	for grid_size in grid_sizes:
+		grid_context = dict(context, grid=grid_size)
+		pending = {nlp_filter.get_output_filename("NLPoutput", *params): params for params in make_run_grid(grid_size).values()}
+		output_dir = os.path.join(workdir, "grid{}".format(grid_size))
+		os.makedirs(output_dir)
+
+		def sweep_text(workers):
+			for output_filename, text in compute_runs(all_terms, clade_data, pending, workers, text=True):
+				write_formatted_blocks(text, os.path.join(output_dir, output_filename))
+
+		for workers in args.workers:
+			#fresh output directory, since rewriting existing files can be much slower than writing new ones
+			shutil.rmtree(output_dir)
+			os.makedirs(output_dir)
+			suffix = " ({} workers)".format(workers) if workers != 1 else ""
+			run_stage(results, grid_context, "sweep_text" + suffix, lambda: sweep_text(workers), len(pending), "runs/s")
+			run_stage(results, grid_context, "sweep_bitmask" + suffix, lambda: write_bitmask(all_terms, dict(compute_runs(all_terms, clade_data, pending, workers)), os.path.join(output_dir, get_bitmask_filename("NLPoutput"))), len(pending), "runs/s")
+		run_stage(results, grid_context, "upload outputs", lambda: upload_changed_files(client, bucket, {os.path.join(output_dir, output_filename): "grid{}/{}".format(grid_size, output_filename) for output_filename in pending.keys()}, "s3_upload_manifest.json", concurrency=args.concurrency), len(pending), "files/s")
+		shutil.rmtree(output_dir)
+
+	os.chdir(bench_dir)
+	env = dict(os.environ, local_s3_root=store_dir, local_s3_latency=str(args.latency))
+
+	if not args.skip_scripts:
+		#whole post_process_NLP.py run (fresh working directory, no cache/shards)
+		script_workdir = os.path.join(bench_dir, "script_workdir")
+		params = {"s3_bucket_name": bucket, "s3_fetch_concurrency": args.concurrency, "workdir": script_workdir, "nlp_terms_filename": "NLPoutput.txt", "nlp_terms_orig_dirname": "Clinithink_raw", "manual_hpo_filename": "output.txt", "nlp_hpo_filename_prefix": "NLPoutput", "nlp_output_dir": "filtered_NLP_outputs", "metrics_file": "pipeline_metrics.jsonl", "vcf_files": vcf_files}
+		with open(os.path.join(bench_dir, "pheno_pipeline_params.yaml"), "w") as fhw:
+			yaml.dump(params, fhw)
+		seconds, peak_rss_bytes = run_process([sys.executable, os.path.join(repo_dir, "post_process_NLP.py"), os.path.join(bench_dir, "pheno_pipeline_params.yaml")], env, bench_dir)
+		report(results, context, "post_process_NLP.py", seconds, peak_rss_bytes, n_patients, "patients/s")
+
+		#exomiser jobs run concurrently as separate processes, as ray_parallel_nlp.py runs its docker tasks
+		bin_dir = os.path.join(bench_dir, "bin")
+		os.makedirs(bin_dir)
+		with open(os.path.join(bin_dir, "java"), "w") as fhw:
+			fhw.write(fake_java.format(python=sys.executable, runtime=args.exomiser_runtime))
+		os.chmod(os.path.join(bin_dir, "java"), 0o755)
+		for root_name in ["data", "results"]:
+			os.makedirs(os.path.join(bench_dir, root_name))
+
+		def exomiser_job(vcf_file):
+			job_env = dict(env, PATH=bin_dir + os.pathsep + env.get("PATH", ""), exomiser_job_id="bench", exomiser_vcf_file=vcf_file, exomiser_hpo_file="s3://{}/NLPoutput.txt".format(bucket), exomiser_base_yml_file="s3://{}/test-analysis-exome.yml".format(bucket), exomiser_Xmx="4g", write_bucket=bucket, exomiser_data_root=os.path.join(bench_dir, "data"), exomiser_results_root=os.path.join(bench_dir, "results"))
+			return(run_process([sys.executable, os.path.join(repo_dir, "run_exomiser_job.py")], job_env, bench_dir))
+
+		jobs = vcf_files[:args.exomiser_jobs]
+		start = time.perf_counter()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=args.exomiser_workers) as executor:
+			job_results = list(executor.map(exomiser_job, jobs))
+		report(results, context, "run_exomiser_job.py", time.perf_counter() - start, max([peak for seconds, peak in job_results], default=0), len(jobs), "jobs/s")
+
+		#the same jobs run by long-lived workers taking them from a job queue
+		queue_dir = os.path.join(bench_dir, "exomiser_job_queue")
+		create_queue(queue_dir)
+		enqueue_jobs(queue_dir, [("{:08d}".format(i), {"job_id": "bench_workers", "vcf_file": vcf_file, "hpo_file": "s3://{}/NLPoutput.txt".format(bucket), "base_yml_file": "s3://{}/test-analysis-exome.yml".format(bucket)}) for i, vcf_file in enumerate(jobs)])
+		close_queue(queue_dir)
+
+		def exomiser_worker(worker_index):
+			worker_env = dict(env, PATH=bin_dir + os.pathsep + env.get("PATH", ""), exomiser_job_queue=queue_dir, exomiser_worker_id="worker{}".format(worker_index), exomiser_batch_size=str(args.exomiser_batch_size), exomiser_Xmx="4g", write_bucket=bucket, exomiser_data_root=os.path.join(bench_dir, "data"), exomiser_results_root=os.path.join(bench_dir, "results"))
+			return(run_process([sys.executable, os.path.join(repo_dir, "run_exomiser_job.py")], worker_env, bench_dir))
+
+		start = time.perf_counter()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=args.exomiser_workers) as executor:
+			worker_results = list(executor.map(exomiser_worker, range(args.exomiser_workers)))
+		seconds = time.perf_counter() - start
+		if not all(spec["succeeded"] for spec in get_done_jobs(queue_dir).values()):
+			raise RuntimeError("exomiser worker jobs failed")
+		report(results, context, "exomiser_workers", seconds, max([peak for seconds, peak in worker_results], default=0), len(jobs), "jobs/s")
+
+
+#compare results with the latest baseline record of the same stage/cohort/grid; returns the regressed records
+def compare_baseline(results, baseline_filename, tolerance):
+	baseline = {}
+	with open(baseline_filename) as fh:
+		for line in fh:
+			record = json.loads(line)
+			baseline[(record["stage"], record["patients"], record["grid"], record.get("latency"))] = record
+
+	regressions = []
+	print("\nComparison with {} (slower than {}x flagged)".format(baseline_filename, tolerance))
+	for record in results:
+		previous = baseline.get((record["stage"], record["patients"], record["grid"], record["latency"]))
+		if previous is None:
+			continue
+		ratio = record["seconds"] / max(previous["seconds"], 1e-9)
+		regressed = ratio > tolerance and record["seconds"] - previous["seconds"] > 0.01
+		if regressed:
+			regressions.append(record)
+		print("{:>9} {:>5} {:<22} {:>9.3f} vs {:>9.3f} {:>6.2f}x{}".format(record["patients"], record["grid"] or "", record["stage"], record["seconds"], previous["seconds"], ratio, "  REGRESSION" if regressed else ""))
+	return(regressions)
+
+
+def get_commit():
+	try:
+		return(subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip())
+	except (OSError, subprocess.CalledProcessError):
+		return(None)
+
+
+parser = argparse.ArgumentParser(description="Offline benchmark of the NLP filter and exomiser pipeline on synthetic cohorts")
+parser.add_argument("--patients", type=int, nargs="+", default=[100, 1000, 10000], help="cohort sizes")
+parser.add_argument("--grid", type=int, nargs="+", default=[42, 294], help="NLP filter grid sizes (number of runs)")
+parser.add_argument("--workers", type=int, nargs="+", default=[1], help="NLP filter sweep worker counts (0 for all cores)")
+parser.add_argument("--terms", type=int, default=5000, help="number of HPO terms in the synthetic HPO tables")
+parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every local object store request")
+parser.add_argument("--concurrency", type=int, default=16, help="S3 transfer threads")
+parser.add_argument("--exomiser-jobs", type=int, default=16, help="number of run_exomiser_job.py runs per cohort")
+parser.add_argument("--exomiser-workers", type=int, default=4, help="number of exomiser jobs run at once")
+parser.add_argument("--exomiser-batch-size", type=int, default=1, help="number of jobs a queue worker runs per exomiser process")
+parser.add_argument("--exomiser-runtime", type=float, default=0.0, help="seconds the stand-in java sleeps per job")
+parser.add_argument("--skip-scripts", action="store_true", help="only benchmark the in-process stages")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--output", help="JSON lines file the results are appended to")
+parser.add_argument("--baseline", help="JSON lines file of earlier results to compare with")
+parser.add_argument("--tolerance", type=float, default=1.25, help="slowdown relative to the baseline reported as a regression")
+args = parser.parse_args()
+args.commit = get_commit()
+
+results = []
+print("{:>9} {:>5} {:<22} {:>9} {:>10} {:>12}".format("patients", "grid", "stage", "time (s)", "peak (MB)", "throughput"))
+for n_patients in args.patients:
+	bench_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+	try:
+		bench_cohort(results, n_patients, args.grid, args, bench_dir)
+	finally:
+		os.chdir(repo_dir)
+		shutil.rmtree(bench_dir)
+
+if args.output:
+	with open(args.output, "a") as fhw:
+		for record in results:
+			fhw.write(json.dumps(record) + "\n")
+
+if args.baseline and len(compare_baseline(results, args.baseline, args.tolerance)) > 0:
+	sys.exit(1)
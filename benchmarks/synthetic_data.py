@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+##################################################
+## Synthetic inputs for the offline pipeline benchmarks: HPO depth/clade tables (hpo_multishortest_paths_stats.csv
+## and hpo_multishortest_paths.csv, with the columns of the real tables), per-patient raw Clinithink CSVs, VCF stubs, a base Exomiser analysis yml,
+## and NLP filter grids of a given size. A cohort is written into a local object store (local_object_store.LocalS3Client)
+## with the same bucket layout the pipeline scripts expect on S3.
+##################################################
+
+import itertools
+import numpy as np
+import pandas as pd
+import yaml
+
+
+#the 23 root phenotype clades are stood in for by HPO IDs of the form HP:99000##
+num_root_clades = 23
+
+
+def make_hpo_tables(n_terms, seed=0):
+	rng = np.random.default_rng(seed)
+	term_numbers = rng.choice(np.arange(1, 10 * n_terms), n_terms, replace=False)
+	hpo_ids = np.array(["HP:{:07d}".format(x) for x in term_numbers], dtype=object)
+	criteria = np.array(["HP{:07d}_Synthetic_term_{}".format(x, x) for x in term_numbers], dtype=object)
+
+	#~5% of terms have no depth, ~2% have two rows in the stats table
+	in_stats = rng.random(n_terms) >= 0.05
+	duplicated = in_stats & (rng.random(n_terms) < 0.02)
+	stats_ids = np.r_[hpo_ids[in_stats], hpo_ids[duplicated]]
+	min_path_length = rng.integers(1, 14, len(stats_ids)).astype(float)
+	min_path_length[rng.random(len(stats_ids)) < 0.02] = np.nan
+	stats = pd.DataFrame({"HPO_ID": stats_ids, "min_path_length": min_path_length, "max_path_length": min_path_length + rng.integers(0, 4, len(stats_ids))})
+
+	#1-3 clades per term, ~5% of terms without clades
+	in_clades = rng.random(n_terms) >= 0.05
+	clades_per_term = rng.integers(1, 4, in_clades.sum())
+	clades = pd.DataFrame({"HPO_ID": np.repeat(hpo_ids[in_clades], clades_per_term), "root_phenos": ["HP:99000{:02d}".format(x) for x in rng.integers(0, num_root_clades, clades_per_term.sum())]})
+	clades = clades.drop_duplicates()
+
+	#the stats table also lists each term's clades, as a python list literal (empty for terms without clades)
+	term_clades = clades.groupby("HPO_ID", sort=False).root_phenos.agg(lambda x: str(list(x)))
+	stats["root_phenos"] = stats.HPO_ID.map(term_clades).fillna("[]")
+
+	return(stats, clades, criteria)
+
+
+#raw Clinithink output of one patient (criteria with uppercase HP, as exported)
+def make_clinithink_csv(rng, criteria, min_terms=5, max_terms=80):
+	patient_criteria = rng.choice(criteria, rng.integers(min_terms, max_terms + 1), replace=False)
+	frequencies = rng.choice([1, 1, 1, 2, 2, 3, 4, 5, 8, 12, 16, 32], len(patient_criteria))
+	return("Criterion,Frequency\n" + "".join("{},{}\n".format(criterion, frequency) for criterion, frequency in zip(patient_criteria, frequencies)))
+
+
+def make_vcf_stub(sample_id, n_variants=20, seed=0):
+	rng = np.random.default_rng(seed)
+	lines = ["##fileformat=VCFv4.2", "##reference=hg19", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}".format(sample_id)]
+	for chrom, pos in sorted(zip(rng.integers(1, 23, n_variants), rng.integers(10000, 100000000, n_variants))):
+		lines.append("{}\t{}\t.\tA\tG\t50\tPASS\t.\tGT\t0/1".format(chrom, pos))
+	return("\n".join(lines) + "\n")
+
+
+def make_base_analysis_yml():
+	return(yaml.dump({"analysis": {"genomeAssembly": "hg19", "vcf": None, "ped": None, "proband": None, "hpoIds": [], "analysisMode": "PASS_ONLY"}, "outputOptions": {"outputContributingVariantsOnly": False, "numGenes": 0, "outputPrefix": None, "outputFormats": ["HTML", "JSON"]}}, sort_keys=False))
+
+
+#write a cohort of n_patients into bucket of a LocalS3Client:
+#Clinithink_raw/<####-01>.csv, hpo_multishortest_paths(_stats).csv, MAN_<####-01>_BCH-<n>.vcf and test-analysis-exome.yml
+#returns the S3 paths of the VCFs (the yaml vcf_files list)
+def make_cohort(client, bucket, n_patients, n_terms=5000, nlp_terms_orig_dirname="Clinithink_raw", seed=0):
+	rng = np.random.default_rng(seed)
+	stats, clades, criteria = make_hpo_tables(n_terms, seed)
+	client.put_object(Bucket=bucket, Key="hpo_multishortest_paths_stats.csv", Body=stats.to_csv(index=False))
+	client.put_object(Bucket=bucket, Key="hpo_multishortest_paths.csv", Body=clades.to_csv(index=False))
+	client.put_object(Bucket=bucket, Key="test-analysis-exome.yml", Body=make_base_analysis_yml())
+
+	vcf_files = []
+	for patient_number in range(n_patients):
+		manton_id = "{:06d}-01".format(patient_number)
+		sample_id = "MAN_{}_BCH-{}".format(manton_id, patient_number)
+		client.put_object(Bucket=bucket, Key="{}/{}.csv".format(nlp_terms_orig_dirname, manton_id), Body=make_clinithink_csv(rng, criteria))
+		client.put_object(Bucket=bucket, Key=sample_id + ".vcf", Body=make_vcf_stub(sample_id, seed=patient_number))
+		vcf_files.append("s3://{}/{}.vcf".format(bucket, sample_id))
+
+	return(vcf_files)
+
+
+#grid_size NLP filter runs {runName: [min_freq, min_depth, max_depth, num_clades]} taken in order from the paper's
+#7 x 6 x 7 = 294 combinations, repeated with max_depth values 14, 13, ... 1 for grids larger than 294 runs
+def make_run_grid(grid_size):
+	runs = {}
+	combinations = itertools.product([100] + list(range(14, 0, -1)), [0, 40, 50, 60, 70, 80, 90], [0, 4, 5, 6, 7, 8], [100, 2, 4, 6, 8, 10, 12])
+	for max_depth, min_freq, min_depth, num_clades in itertools.islice(combinations, grid_size):
+		runs["NLP_fp{}_c{}_d{}_maxd{}".format(min_freq, num_clades, min_depth, max_depth)] = [min_freq, min_depth, max_depth, num_clades]
+	return(runs)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+##################################################
+## This module reads and writes HPO term lists in the combined patient Clinithink format:
+## PatientID1
+## Criterion,Frequency
+## hp0002813_Abnormality_of_limb_bone_morphology,32
+## hp0012531_Pain,16
+## PatientID2
+## Criterion,Frequency
+## hp0001298_Encephalopathy,19
+##################################################
+
+import io
+import csv
+import gzip
+import numpy as np
+import pandas as pd
+
+
+write_buffer_size = 1 << 20
+read_chunk_size = 1 << 24 #characters read at a time by iter_patient_chunks
+
+
+#parse the combined patient Clinithink format (a path or file object) into a (Patient, Criterion, Frequency) table in file order
+#lines are tokenized in bulk by the pandas C parser (fields after the second are ignored); lines without a comma are patient IDs
+#and each term row belongs to the closest patient ID above it, found with a single searchsorted
+def read_patient_blocks(source):
+	try:
+		table = pd.read_csv(source, header=None, names=["Criterion", "Frequency"], usecols=[0, 1], quoting=csv.QUOTE_NONE, skipinitialspace=True, keep_default_na=False, na_values={"Frequency": ["", "Frequency"]}, dtype={"Criterion": object, "Frequency": np.float64}, engine="c")
+	except pd.errors.EmptyDataError:
+		return(pd.DataFrame({"Patient": np.array([], dtype=object), "Criterion": np.array([], dtype=object), "Frequency": np.array([], dtype=np.int64)}))
+
+	criteria = table.Criterion.values
+	frequencies = table.Frequency.values
+	is_term = ~np.isnan(frequencies)
+	patient_lines = np.flatnonzero(~is_term & (criteria != "Criterion"))
+	term_lines = np.flatnonzero(is_term)
+	owners = np.searchsorted(patient_lines, term_lines, side="right") - 1
+	if len(owners) > 0 and owners[0] < 0:
+		raise ValueError("HPO term found before the first patient ID: {}".format(criteria[term_lines[0]]))
+	patients = table.Criterion.iloc[patient_lines].str.strip().values
+
+	return(pd.DataFrame({"Patient": patients[owners], "Criterion": criteria[term_lines], "Frequency": frequencies[term_lines].astype(np.int64)}))
+
+
+#yield tables (as read_patient_blocks) of whole patients, reading about chunk_size characters of the file at a time
+def iter_patient_chunks(input_filename, chunk_size=read_chunk_size):
+	with open(input_filename) as fh:
+		text = ""
+		while True:
+			chunk = fh.read(chunk_size)
+			if chunk == "":
+				break
+			text += chunk
+			#the last patient read may continue in the next chunk, so it is carried over from the line holding its ID
+			header = text.rfind("\nCriterion,Frequency")
+			start = text.rfind("\n", 0, header) + 1 if header > 0 else 0
+			if start > 0:
+				yield read_patient_blocks(io.StringIO(text[:start]))
+				text = text[start:]
+		if text != "":
+			yield read_patient_blocks(io.StringIO(text))
+
+
+#byte ranges of the patient blocks of a combined file, as [(patient, start, end)] in file order
+#blocks are found by their "Criterion,Frequency" header line, reading chunk_size bytes at a time
+def index_patient_blocks(input_filename, chunk_size=read_chunk_size):
+	blocks = []
+	with open(input_filename, "rb") as fh:
+		buffer = b""
+		buffer_offset = 0
+		while True:
+			chunk = fh.read(chunk_size)
+			buffer += chunk
+			#the last complete line may be a patient ID whose header line has not been read yet, so it is searched again with the next chunk
+			last_line = buffer.rfind(b"\n", 0, buffer.rfind(b"\n")) + 1 if chunk != b"" else len(buffer)
+			header = buffer.find(b"\nCriterion,Frequency")
+			while header >= 0:
+				start = buffer.rfind(b"\n", 0, header) + 1
+				if start >= last_line:
+					break
+				blocks.append((buffer[start:header].decode().strip(), buffer_offset + start))
+				header = buffer.find(b"\nCriterion,Frequency", header + 1)
+			if chunk == b"":
+				break
+			buffer = buffer[last_line:]
+			buffer_offset += last_line
+		file_size = buffer_offset + len(buffer)
+	return([(patient, start, end) for (patient, start), end in zip(blocks, [start for patient, start in blocks[1:]] + [file_size])])
+
+
+#yield tables (as read_patient_blocks) of whole patients in sorted patient order (the order terms are written in),
+#each parsed from about chunk_size bytes of patient blocks read from their offsets in the file
+def iter_sorted_patient_chunks(input_filename, chunk_size=read_chunk_size):
+	blocks = sorted(index_patient_blocks(input_filename), key=lambda block: block[0])
+	with open(input_filename, "rb") as fh:
+		texts = []
+		num_bytes = 0
+		for i, (patient, start, end) in enumerate(blocks):
+			fh.seek(start)
+			text = fh.read(end - start)
+			texts.append(text if text.endswith(b"\n") else text + b"\n")
+			num_bytes += len(text)
+			#blocks of the same patient are kept in the same chunk
+			if num_bytes >= chunk_size and (i + 1 == len(blocks) or blocks[i + 1][0] != patient):
+				yield read_patient_blocks(io.BytesIO(b"".join(texts)))
+				texts = []
+				num_bytes = 0
+		if len(texts) > 0:
+			yield read_patient_blocks(io.BytesIO(b"".join(texts)))
+
+
+#yield (patient, rows) for each run of consecutive rows of the same patient in a (Patient, Criterion, Frequency) table
+def split_patients(data):
+	patients = data.Patient.values
+	starts = np.flatnonzero(np.r_[True, patients[1:] != patients[:-1]]) if len(data) > 0 else []
+	ends = np.r_[starts[1:], len(data)]
+	for start, end in zip(starts, ends):
+		yield patients[start], data.iloc[start:end]
+
+
+#stream the combined patient Clinithink format one patient at a time, as (patient, rows) pairs
+def iter_patients(input_filename, chunk_size=read_chunk_size):
+	for data in iter_patient_chunks(input_filename, chunk_size):
+		yield from split_patients(data)
+
+
+#HPO IDs (HP:#######) of Clinithink criteria (hp#######_Term_name)
+def get_hpo_ids(criteria):
+	return(criteria.str.split("_").str[0].str.replace("hp", "HP:", regex=False).values)
+
+
+#render (Patient, Criterion, Frequency) rows as one block per patient (sorted by patient, rows in their original order)
+#the text is built with vectorized string operations and a single join instead of one write per row
+def format_patient_blocks(data):
+	if len(data) == 0:
+		return("")
+	if not data.Patient.is_monotonic_increasing:
+		data = data.iloc[np.argsort(data.Patient.values, kind="stable")]
+
+	patients = data.Patient.values.astype(object)
+	new_patient = np.r_[True, patients[1:] != patients[:-1]]
+	headers = np.where(new_patient, patients + "\nCriterion,Frequency\n", "")
+	rows = headers + data.Criterion.values.astype(object) + "," + data.Frequency.astype(str).values.astype(object) + "\n"
+	return("".join(rows))
+
+
+#write rows in the combined patient Clinithink format through a large buffer, optionally gzip compressed
+def write_patient_blocks(data, output_path, compress=False):
+	write_formatted_blocks(format_patient_blocks(data), output_path, compress)
+
+
+#write text already rendered by format_patient_blocks (appended to the file if append; gzip files then get one member per write)
+def write_formatted_blocks(text, output_path, compress=False, append=False):
+	if compress:
+		fhw = gzip.open(output_path, "at" if append else "wt")
+	else:
+		fhw = open(output_path, "a" if append else "w", buffering=write_buffer_size)
+	fhw.write(text)
+	fhw.close()
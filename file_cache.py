@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+##################################################
+## This module implements a content-addressed file cache in a local directory that can be shared between runs
+## and experiments. Entries are stored as <cache_dir>/<key[:2]>/<key>, where the key is a hash of everything that
+## determines the file's content. The entry mtime records its last use, and the least recently used entries are
+## evicted once the cache grows past its size limit. Entries are written to a temporary name and renamed into
+## place, so concurrent processes sharing the directory never see partial files.
+##################################################
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+
+
+def file_sha256(path):
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as fh:
+		for chunk in iter(lambda: fh.read(1 << 20), b""):
+			sha256.update(chunk)
+	return(sha256.hexdigest())
+
+
+#cache key of any json-serializable description (input hashes, parameters, ...)
+def get_cache_key(*parts):
+	return(hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest())
+
+
+def get_cache_path(cache_dir, key):
+	return(os.path.join(cache_dir, key[:2], key))
+
+
+#copy a file to output_path through a temporary name in the same directory
+def _copy_atomic(source_path, output_path):
+	tmp_path = "{}.tmp.{}".format(output_path, uuid.uuid4().hex)
+	try:
+		shutil.copyfile(source_path, tmp_path)
+		os.replace(tmp_path, output_path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+
+
+#copy the cached entry for key to output_path and mark it as recently used; returns False on a cache miss
+def cache_fetch(cache_dir, key, output_path):
+	entry_path = get_cache_path(cache_dir, key)
+	try:
+		_copy_atomic(entry_path, output_path)
+		os.utime(entry_path)
+	except FileNotFoundError: #not cached, or evicted by another process
+		return(False)
+	return(True)
+
+
+def cache_store(cache_dir, key, path):
+	entry_path = get_cache_path(cache_dir, key)
+	os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+	_copy_atomic(path, entry_path)
+
+
+#store bytes (e.g. a file read by another process) under key, through a temporary name like cache_store
+def cache_store_bytes(cache_dir, key, body):
+	entry_path = get_cache_path(cache_dir, key)
+	os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+	tmp_path = "{}.tmp.{}".format(entry_path, uuid.uuid4().hex)
+	try:
+		with open(tmp_path, "wb") as fhw:
+			fhw.write(body)
+		os.replace(tmp_path, entry_path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+
+
+#remove least recently used entries until the cache holds at most max_bytes
+def evict_cache(cache_dir, max_bytes):
+	entries = []
+	for root, dirs, files in os.walk(cache_dir):
+		for name in files:
+			if ".tmp." in name:
+				continue
+			try:
+				stat = os.stat(os.path.join(root, name))
+			except FileNotFoundError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+	total_bytes = sum(size for mtime, size, path in entries)
+	for mtime, size, path in sorted(entries):
+		if total_bytes <= max_bytes:
+			break
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+		total_bytes -= size
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+##################################################
+## This module builds and loads a compact binary index of the HPO depth/clade tables used by the NLP filters
+## (hpo_multishortest_paths_stats.csv and hpo_multishortest_paths.csv), so they do not need to be re-read and
+## joined on string HPO_ID keys.
+##
+## The index is a directory of .npy files that are loaded memory-mapped (and so shared between worker processes
+## through the page cache):
+## hpo_ids        sorted HPO IDs, the position of an ID is its integer code
+## depth_indptr   CSR offsets of each HPO ID into depth_values (an HPO ID can have several rows in the stats table)
+## depth_values   min_path_length (nan if unknown)
+## clade_indptr   CSR offsets of each HPO ID into clade_codes
+## clade_codes    codes into clade_names of the HPO ID's root phenotype clades
+## clade_names    root phenotype clade names
+## The index is rebuilt whenever the hashes of the source tables recorded in sources.json do not match.
+##################################################
+
+import os
+import json
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+from file_cache import file_sha256
+
+
+index_arrays = ["hpo_ids", "depth_indptr", "depth_values", "clade_indptr", "clade_codes", "clade_names"]
+
+
+#CSR offsets/order grouping the rows of codes (in file order) by code
+def _csr(codes, num_codes):
+	order = np.argsort(codes, kind="stable")
+	indptr = np.zeros(num_codes + 1, dtype=np.int64)
+	np.cumsum(np.bincount(codes, minlength=num_codes), out=indptr[1:])
+	return(indptr, order)
+
+
+def build_hpo_index(clade_depth_file, clades_list_file, index_dir):
+	clade_depth_data = pd.read_csv(clade_depth_file)
+	clades_list_data = pd.read_csv(clades_list_file)
+	clade_depth_data = clade_depth_data.loc[clade_depth_data.HPO_ID.notna(), :]
+	clades_list_data = clades_list_data.loc[clades_list_data.HPO_ID.notna(), :]
+
+	hpo_ids = np.unique(np.r_[clade_depth_data.HPO_ID.values.astype(str), clades_list_data.HPO_ID.values.astype(str)])
+
+	depth_indptr, depth_order = _csr(np.searchsorted(hpo_ids, clade_depth_data.HPO_ID.values.astype(str)), len(hpo_ids))
+	depth_values = clade_depth_data.min_path_length.values.astype(np.float64)[depth_order]
+
+	#nan clades are "unknown", the same as HPO IDs without clades
+	clade_names, clade_codes = np.unique(clades_list_data.root_phenos.fillna("unknown").values.astype(str), return_inverse=True)
+	clade_indptr, clade_order = _csr(np.searchsorted(hpo_ids, clades_list_data.HPO_ID.values.astype(str)), len(hpo_ids))
+	clade_codes = clade_codes.astype(np.int32)[clade_order]
+
+	#write into a temporary directory and rename it into place so readers never see a partial index
+	tmp_dir = "{}.tmp.{}".format(index_dir.rstrip("/"), uuid.uuid4().hex)
+	os.makedirs(tmp_dir)
+	for name, values in zip(index_arrays, [hpo_ids, depth_indptr, depth_values, clade_indptr, clade_codes, clade_names]):
+		np.save(os.path.join(tmp_dir, name + ".npy"), values)
+	with open(os.path.join(tmp_dir, "sources.json"), "w") as fhw:
+		json.dump({"clade_depth_file": file_sha256(clade_depth_file), "clades_list_file": file_sha256(clades_list_file)}, fhw)
+	if os.path.exists(index_dir):
+		shutil.rmtree(index_dir)
+	os.replace(tmp_dir, index_dir)
+
+
+def load_hpo_index(index_dir):
+	return({name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r") for name in index_arrays})
+
+
+#load the index in index_dir, building it first if it is missing or out of date with the source tables
+def get_hpo_index(clade_depth_file, clades_list_file, index_dir):
+	sources = None
+	if os.path.exists(os.path.join(index_dir, "sources.json")):
+		with open(os.path.join(index_dir, "sources.json")) as fh:
+			sources = json.load(fh)
+	if sources != {"clade_depth_file": file_sha256(clade_depth_file), "clades_list_file": file_sha256(clades_list_file)}:
+		build_hpo_index(clade_depth_file, clades_list_file, index_dir)
+	return(load_hpo_index(index_dir))
+
+
+#integer codes of HPO IDs (-1 if not in the index)
+def lookup_hpo_ids(hpo_index, hpo_ids):
+	hpo_ids = np.asarray(hpo_ids).astype(str)
+	index_ids = hpo_index["hpo_ids"]
+	if len(index_ids) == 0:
+		return(np.full(len(hpo_ids), -1))
+	codes = np.minimum(np.searchsorted(index_ids, hpo_ids), len(index_ids) - 1)
+	return(np.where(index_ids[codes] == hpo_ids, codes, -1))
+
+
+#expand each row by the CSR entries of its code, keeping rows without entries once
+#returns (row each expanded row comes from, position of its entry in the CSR values, or -1 if it has none)
+def _expand(codes, indptr):
+	starts = np.where(codes >= 0, indptr[np.maximum(codes, 0)], 0)
+	counts = np.where(codes >= 0, indptr[np.maximum(codes, 0) + 1] - starts, 0)
+	repeats = np.maximum(counts, 1)
+	rows = np.repeat(np.arange(len(codes)), repeats)
+	offsets = np.arange(len(rows)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+	entries = np.where(counts[rows] > 0, starts[rows] + offsets, -1)
+	return(rows, entries)
+
+
+#left join of HPO codes (as lookup_hpo_ids) with the depth table and then the clade list, the same as joining the csv tables on HPO_ID
+#returns (row of codes each joined row comes from, min_path_length, root phenotype clade code in clade_names, or -1 for "unknown")
+def join_hpo_codes(hpo_index, codes):
+
+	#entry -1 picks the appended nan depth / "unknown" clade
+	depth_rows, depth_entries = _expand(codes, hpo_index["depth_indptr"])
+	min_path_length = np.r_[hpo_index["depth_values"], np.nan][depth_entries]
+
+	#clades named "unknown" (nan in the clade list) are the same clade as HPO IDs without clades
+	clade_rows, clade_entries = _expand(codes[depth_rows], hpo_index["clade_indptr"])
+	clade_names = hpo_index["clade_names"]
+	clade_code_map = np.where(clade_names == "unknown", -1, np.arange(len(clade_names)))
+	clade_codes = np.r_[clade_code_map[hpo_index["clade_codes"]], -1][clade_entries]
+
+	return(depth_rows[clade_rows], min_path_length[clade_rows], clade_codes)
+
+
+#join_hpo_codes for HPO IDs, with clade names ("unknown" if none)
+def join_hpo_index(hpo_index, hpo_ids):
+	rows, min_path_length, clade_codes = join_hpo_codes(hpo_index, lookup_hpo_ids(hpo_index, hpo_ids))
+	clade_names = np.r_[hpo_index["clade_names"].astype(object), np.array(["unknown"], dtype=object)]
+	return(rows, min_path_length, clade_names[clade_codes])
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+##################################################
+## This module implements the local file queue that long-lived exomiser workers (run_exomiser_job.py in worker mode) take jobs from.
+## A queue is a directory (bind mounted into the worker containers) with one JSON job spec per file:
+## pending/<job>.json    jobs waiting to be run (taken in name order)
+## claimed/<worker>.<job>.json    jobs being run by a worker (claimed by an atomic rename, so each job goes to one worker)
+## done/<job>.json    finished jobs with their status and number of attempts
+## closed    created once every job has been added; workers exit when the queue is closed and no job is pending or running
+##################################################
+
+import os
+import json
+import uuid
+import shutil
+
+
+queue_folders = ["pending", "claimed", "done"]
+
+
+#write a json file under a temporary name and rename it into place so readers never see a partial file
+def _write_json(path, data):
+	tmp_path = "{}.tmp.{}".format(path, uuid.uuid4().hex)
+	with open(tmp_path, "w") as fhw:
+		json.dump(data, fhw)
+	os.replace(tmp_path, path)
+
+
+#empty queue in queue_dir (anything already there is removed)
+def create_queue(queue_dir):
+	if os.path.exists(queue_dir):
+		shutil.rmtree(queue_dir)
+	for folder in queue_folders:
+		os.makedirs(os.path.join(queue_dir, folder))
+
+
+#add jobs [(job_name, spec)]; job names must be unique and are the order jobs are taken in
+def enqueue_jobs(queue_dir, jobs):
+	for job_name, spec in jobs:
+		_write_json(os.path.join(queue_dir, "pending", job_name + ".json"), dict(spec, attempts=0))
+
+
+def close_queue(queue_dir):
+	open(os.path.join(queue_dir, "closed"), "w").close()
+
+
+#claim up to max_jobs pending jobs for worker_id; returns [(job_name, spec)]
+#with prefer(spec), jobs it is true for among the next window pending jobs are claimed first (e.g. jobs whose inputs the worker already has)
+def claim_jobs(queue_dir, worker_id, max_jobs=1, prefer=None, window=64):
+	filenames = sorted(filename for filename in os.listdir(os.path.join(queue_dir, "pending")) if filename.endswith(".json"))
+	if prefer is not None:
+		preferred = []
+		for filename in filenames[:window]:
+			try:
+				with open(os.path.join(queue_dir, "pending", filename)) as fh:
+					if prefer(json.load(fh)):
+						preferred.append(filename)
+			except FileNotFoundError: #taken by another worker
+				continue
+		preferred_set = set(preferred)
+		filenames = preferred + [filename for filename in filenames if filename not in preferred_set]
+
+	claimed = []
+	for filename in filenames:
+		if len(claimed) == max_jobs:
+			break
+		claimed_path = os.path.join(queue_dir, "claimed", "{}.{}".format(worker_id, filename))
+		try:
+			os.rename(os.path.join(queue_dir, "pending", filename), claimed_path)
+		except FileNotFoundError: #taken by another worker
+			continue
+		with open(claimed_path) as fh:
+			claimed.append((filename[:-len(".json")], json.load(fh)))
+	return(claimed)
+
+
+#record the result of a claimed job (with any other fields, e.g. its run time); failed jobs go back to pending until they have been attempted max_attempts times
+def complete_job(queue_dir, worker_id, job_name, spec, succeeded, max_attempts=1, **fields):
+	spec = dict(spec, attempts=spec["attempts"] + 1)
+	if succeeded or spec["attempts"] >= max_attempts:
+		_write_json(os.path.join(queue_dir, "done", job_name + ".json"), dict(spec, succeeded=succeeded, **fields))
+	else:
+		_write_json(os.path.join(queue_dir, "pending", job_name + ".json"), spec)
+	os.remove(os.path.join(queue_dir, "claimed", "{}.{}.json".format(worker_id, job_name)))
+
+
+#put jobs claimed by worker_id back in pending (for a worker restarted after its container stopped part way through)
+def release_jobs(queue_dir, worker_id):
+	prefix = "{}.".format(worker_id)
+	for filename in os.listdir(os.path.join(queue_dir, "claimed")):
+		if filename.startswith(prefix):
+			os.rename(os.path.join(queue_dir, "claimed", filename), os.path.join(queue_dir, "pending", filename[len(prefix):]))
+
+
+#record the jobs still claimed by worker_id as failed (for a worker that stopped for good, e.g. its container failed every restart),
+#so they are not left claimed and the queue can drain; returns the names of the failed jobs
+def fail_jobs(queue_dir, worker_id, **fields):
+	prefix = "{}.".format(worker_id)
+	failed = []
+	for filename in sorted(os.listdir(os.path.join(queue_dir, "claimed"))):
+		if filename.startswith(prefix) and filename.endswith(".json"):
+			job_name = filename[len(prefix):-len(".json")]
+			with open(os.path.join(queue_dir, "claimed", filename)) as fh:
+				spec = json.load(fh)
+			complete_job(queue_dir, worker_id, job_name, spec, False, **fields)
+			failed.append(job_name)
+	return(failed)
+
+
+#true once the queue is closed and has no pending or running jobs
+def is_drained(queue_dir):
+	return(os.path.exists(os.path.join(queue_dir, "closed")) and len(os.listdir(os.path.join(queue_dir, "pending"))) == 0 and len(os.listdir(os.path.join(queue_dir, "claimed"))) == 0)
+
+
+#{job_name: spec} of finished jobs, with their succeeded flag
+def get_done_jobs(queue_dir):
+	done_jobs = {}
+	for filename in sorted(os.listdir(os.path.join(queue_dir, "done"))):
+		if filename.endswith(".json"):
+			with open(os.path.join(queue_dir, "done", filename)) as fh:
+				done_jobs[filename[:-len(".json")]] = json.load(fh)
+	return(done_jobs)
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+##################################################
+## This module sizes the Ray resource requests of the exomiser tasks in ray_parallel_nlp.py from the JVM heap (exomiser_Xmx),
+## so Ray packs as many jobs on a node as its memory allows rather than one per CPU, and throttles container launches on a
+## node while its free memory (MemAvailable in /proc/meminfo) is low. Launches on a node are serialized by a lock file and spaced by
+## launch_interval seconds, so each JVM has started growing before the next launch is checked against free memory.
+## Containers are started with a --memory limit of the job's memory, so running out of it is seen as the container's exit status.
+##################################################
+
+import os
+import time
+import fcntl
+import signal
+
+
+memory_units = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+#exit status of a container killed by the kernel OOM killer (SIGKILL)
+oom_exit_status = 137
+
+
+#bytes of a java memory size ("4g", "4096m", "512k" or bytes)
+def parse_memory_size(size):
+	size = str(size).strip().lower()
+	unit = size[-1] if size[-1] in memory_units else ""
+	number = size[:-1] if unit else size
+	if not number.isdigit():
+		raise ValueError("Invalid memory size: {}".format(size))
+	return(int(number) * memory_units[unit])
+
+
+#Ray resources of one exomiser job: its CPUs and memory (JVM heap + overhead_mb for the JVM's non-heap memory and the python wrapper)
+def get_job_resources(Xmx, overhead_mb, num_cpus=1):
+	return({"num_cpus": num_cpus, "memory": parse_memory_size(Xmx) + int(overhead_mb * (1 << 20))})
+
+
+#memory of this node from /proc/meminfo: "MemAvailable" (free memory, counting reclaimable page cache) or "MemTotal"
+def get_node_memory(field="MemAvailable"):
+	with open("/proc/meminfo") as fh:
+		for line in fh:
+			if line.startswith(field + ":"):
+				return(int(line.split()[1]) * 1024)
+	raise RuntimeError("{} not found in /proc/meminfo".format(field))
+
+
+#block until the node has job_memory bytes free plus reserve_bytes, then hold the node's launch lock for launch_interval seconds
+#(polling every poll_interval seconds); returns the seconds waited
+def wait_for_memory(job_memory, reserve_bytes=0, lock_path="/tmp/exomiser_launch.lock", launch_interval=2, poll_interval=5):
+	if job_memory + reserve_bytes > get_node_memory("MemTotal"):
+		raise ValueError("A job needs {:.1f} GB free but the node only has {:.1f} GB of memory".format((job_memory + reserve_bytes) / 2**30, get_node_memory("MemTotal") / 2**30))
+	start = time.time()
+	with open(lock_path, "a") as lock_fh:
+		fcntl.flock(lock_fh, fcntl.LOCK_EX)
+		try:
+			while get_node_memory() < job_memory + reserve_bytes:
+				time.sleep(poll_interval)
+			waited = time.time() - start
+			time.sleep(launch_interval)
+		finally:
+			fcntl.flock(lock_fh, fcntl.LOCK_UN)
+	return(waited)
+
+
+#docker run command of a container limited to memory bytes (with no swap beyond it), the memory its Ray task reserves; a JVM that
+#outgrows it is killed by the container's OOM killer instead of the host's, and run_exomiser_job.py then exits with oom_exit_status
+def get_docker_call(image, docker_args, command, memory):
+	return("docker run --memory={0} --memory-swap={0} {1} {2} {3}".format(int(memory), docker_args, image, command))
+
+
+#true if a wait status is a process killed by SIGKILL (the OOM killer), directly or as reported by the shell os.system ran it in
+def is_killed(status):
+	return((os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGKILL) or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == oom_exit_status))
+
+
+#true if an os.system wait status is a container killed for running out of memory
+def is_oom_exit(status):
+	return(os.WIFEXITED(status) and os.WEXITSTATUS(status) == oom_exit_status)
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+##################################################
+## This module provides a local-filesystem stand-in for the subset of the boto3 S3 client used by the pipeline
+## (get_object, put_object, copy_object, head_object, upload_file, download_file), and for the resource API calls built on it
+## (Bucket().download_file/upload_file, Object().load()). Objects are stored as files under <root_dir>/<bucket>/<key>.
+## Optional per-request latency and injected transient errors make it possible to exercise and time the S3 code paths offline.
+##################################################
+
+import os
+import io
+import time
+import random
+import shutil
+import hashlib
+import threading
+import types
+import botocore.exceptions
+
+
+class LocalS3Client:
+
+	def __init__(self, root_dir, latency=0.0, transient_error_rate=0.0, seed=None):
+		self.root_dir = root_dir
+		self.latency = latency #seconds added to every request
+		self.transient_error_rate = transient_error_rate #fraction of requests failing with a retryable SlowDown error
+		self.request_count = 0
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+
+	def _path(self, bucket, key):
+		return(os.path.join(self.root_dir, bucket, key))
+
+	def _request(self, operation_name):
+		with self._lock:
+			self.request_count += 1
+			fail = self._random.random() < self.transient_error_rate
+		if self.latency > 0:
+			time.sleep(self.latency)
+		if fail:
+			raise botocore.exceptions.ClientError({"Error": {"Code": "SlowDown", "Message": "Injected transient error"}}, operation_name)
+
+	def _not_found(self, bucket, key, operation_name):
+		raise botocore.exceptions.ClientError({"Error": {"Code": "404", "Message": "Not Found: s3://{}/{}".format(bucket, key)}}, operation_name)
+
+	def _etag(self, path):
+		md5 = hashlib.md5()
+		with open(path, "rb") as fh:
+			for chunk in iter(lambda: fh.read(1 << 20), b""):
+				md5.update(chunk)
+		return('"{}"'.format(md5.hexdigest()))
+
+	def head_object(self, Bucket, Key):
+		self._request("HeadObject")
+		path = self._path(Bucket, Key)
+		if Key.endswith("/") and os.path.isdir(path): #"folder" placeholder objects
+			return({"ContentLength": 0, "ETag": '"{}"'.format(hashlib.md5(b"").hexdigest()), "Metadata": {}})
+		if not os.path.isfile(path):
+			self._not_found(Bucket, Key, "HeadObject")
+		return({"ContentLength": os.path.getsize(path), "ETag": self._etag(path), "Metadata": {}})
+
+	def get_object(self, Bucket, Key):
+		self._request("GetObject")
+		path = self._path(Bucket, Key)
+		if not os.path.isfile(path):
+			self._not_found(Bucket, Key, "GetObject")
+		with open(path, "rb") as fh:
+			body = fh.read()
+		return({"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+	def put_object(self, Bucket, Key, Body=b""):
+		self._request("PutObject")
+		path = self._path(Bucket, Key)
+		if Key.endswith("/"): #"folder" placeholder objects
+			os.makedirs(path, exist_ok=True)
+			return({})
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as fhw:
+			fhw.write(Body.encode() if isinstance(Body, str) else Body)
+		return({"ETag": self._etag(path)})
+
+	def copy_object(self, Bucket, Key, CopySource):
+		self._request("CopyObject")
+		source_path = self._path(CopySource["Bucket"], CopySource["Key"])
+		if not os.path.isfile(source_path):
+			self._not_found(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+		path = self._path(Bucket, Key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		shutil.copyfile(source_path, path)
+		return({"CopyObjectResult": {"ETag": self._etag(path)}})
+
+	def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+		self._request("PutObject")
+		path = self._path(Bucket, Key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		shutil.copyfile(Filename, path)
+
+	def download_file(self, Bucket, Key, Filename):
+		self._request("GetObject")
+		path = self._path(Bucket, Key)
+		if not os.path.isfile(path):
+			self._not_found(Bucket, Key, "GetObject")
+		shutil.copyfile(path, Filename)
+
+
+#boto3.resource("s3") stand-in on top of a LocalS3Client
+class LocalS3Resource:
+
+	def __init__(self, client):
+		self.meta = types.SimpleNamespace(client=client)
+
+	def Bucket(self, name):
+		return(LocalS3Bucket(self.meta.client, name))
+
+	def Object(self, bucket_name, key):
+		return(LocalS3Object(self.meta.client, bucket_name, key))
+
+
+class LocalS3Bucket:
+
+	def __init__(self, client, name):
+		self.client = client
+		self.name = name
+
+	def download_file(self, Key, Filename):
+		self.client.download_file(self.name, Key, Filename)
+
+	def upload_file(self, Filename, Key, ExtraArgs=None):
+		self.client.upload_file(Filename, self.name, Key, ExtraArgs=ExtraArgs)
+
+
+class LocalS3Object:
+
+	def __init__(self, client, bucket_name, key):
+		self.client = client
+		self.bucket_name = bucket_name
+		self.key = key
+
+	def load(self):
+		self.client.head_object(Bucket=self.bucket_name, Key=self.key)
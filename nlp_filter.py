@@ -0,0 +1,545 @@
+#!/usr/bin/python
+
+##################################################
+## This module implements the NLP HPO term filters (frequency, depth, and diversity/maxClades) used by post_process_NLP.py
+##
+## The combined Clinithink patient-block file is parsed, ranked, and joined with the HPO depth/clade tables once,
+## and every (min_freq, min_depth, max_depth, num_clades) combination of a sweep is derived from that shared state.
+## Each filtered term list is written in the same combined patient Clinithink format as the input, or the whole sweep is
+## written to a single bitmask file or a single columnar (Parquet) file.
+##################################################
+
+import os
+import json
+import uuid
+import time
+import collections
+import multiprocessing
+import numpy as np
+import pandas as pd
+from clinithink_format import read_patient_blocks, iter_sorted_patient_chunks, get_hpo_ids, format_patient_blocks, write_patient_blocks, write_formatted_blocks
+from file_cache import file_sha256, get_cache_key, cache_fetch, cache_store, evict_cache
+from hpo_index import get_hpo_index, lookup_hpo_ids, join_hpo_codes
+from pipeline_metrics import stage, record_metrics, rss_bytes
+
+
+#fixed parameters that can be adjusted later
+min_freq_as_percent = True
+min_terms = 5
+clade_depth_file = "hpo_multishortest_paths_stats.csv"
+clades_list_file = "hpo_multishortest_paths.csv"
+hpo_index_dir = "hpo_index" #binary index of the two tables above, built from them on first use
+cache_version = 1 #increment when the filter logic changes so that cached results are not reused
+chunk_memory_per_input_byte = 20 #approximate peak memory of a chunked sweep per byte of input in a chunk (parsed terms, clade join, ranked clades and run outputs)
+
+
+#mean of values per group id, broadcast back to each row (same as groupby().transform(lambda x: x.mean()))
+#groups of equal size are stacked and summed row-wise so numpy uses the same pairwise summation as Series.mean(),
+#which keeps the float results (and therefore the clade rank ties) bit-identical
+def group_mean(group_ids, values):
+	order = np.argsort(group_ids, kind="stable")
+	sorted_ids = group_ids[order]
+	sorted_values = values[order]
+	starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(order) > 0 else np.array([], dtype=int)
+	counts = np.diff(np.r_[starts, len(order)])
+
+	sums = np.empty(len(starts))
+	for size in np.unique(counts):
+		groups = np.flatnonzero(counts == size)
+		sums[groups] = np.add.reduce(sorted_values[starts[groups, None] + np.arange(size)], axis=1)
+
+	means = np.empty(len(values))
+	means[order] = np.repeat(sums / counts, counts)
+	return(means)
+
+
+#filtered filename for a single parameter combination
+def get_output_filename(filename_prefix, min_freq, min_depth, max_depth, num_clades):
+	return("{}_minfreq{}{}_mindepth{}_maxdepth{}_numclades{}.txt".format(filename_prefix, "percent" if min_freq_as_percent else "", min_freq, min_depth, max_depth, num_clades))
+
+
+#read combined Clinithink patient-block file into a (Patient, Criterion, Frequency) table
+def read_terms(input_filename):
+	return(read_patient_blocks(input_filename))
+
+
+#codes of the distinct rows of integer code arrays, numbered in order of first appearance (as groupby(sort=False).ngroup())
+def factorize_rows(*code_arrays):
+	row_codes = np.zeros(len(code_arrays[0]), dtype=np.int64)
+	for codes in code_arrays:
+		row_codes = pd.factorize(row_codes * (int(codes.max()) + 1 if len(codes) > 0 else 1) + codes)[0]
+	return(row_codes)
+
+
+#compute percentiles and join terms with the clade/depth data once for all filter combinations
+#returns the unique term list sorted in output order (patient, then original term order), which every run selects rows from,
+#and the clade-expanded term table with each row's position (term_row) in that list
+#the clade-expanded table only holds integer codes and narrow numeric columns: patient_index (position of the patient in
+#sorted order), term_row, Frequency, percentile, min_path_length (nan if unknown) and clade (-1 for "unknown")
+def prepare_terms(data, hpo_index):
+
+	#integer codes of the string keys (patient codes follow the sorted patient IDs, the order terms are written in)
+	patient_codes, patients = pd.factorize(data.Patient.values, sort=True)
+	criterion_codes, criteria = pd.factorize(data.Criterion.values)
+	frequency = data.Frequency.values
+
+	#compute percentile frequency per patient
+	patient_frequency = pd.Series(frequency).groupby(patient_codes)
+	percentile = (patient_frequency.rank() / patient_frequency.transform("size")).values
+
+	#unique (Patient, Criterion, Frequency) rows; a stable sort by patient gives the order terms are written in
+	term_ids = factorize_rows(patient_codes, criterion_codes, pd.factorize(frequency)[0])
+	first_rows = np.flatnonzero(~pd.Series(term_ids).duplicated().values)
+	first_rows = first_rows[np.argsort(patient_codes[first_rows], kind="stable")]
+	all_terms = pd.DataFrame({"Patient": data.Patient.values[first_rows], "Criterion": data.Criterion.values[first_rows], "Frequency": frequency[first_rows], "patient_index": patient_codes[first_rows].astype(np.int32)})
+	term_rows = np.empty(len(first_rows), dtype=np.int32)
+	term_rows[term_ids[first_rows]] = np.arange(len(first_rows))
+
+	#merge with clade/depth data by array lookups in the HPO index (each distinct criterion is looked up once)
+	#rows are expanded in place so any row subset keeps its order
+	hpo_codes = lookup_hpo_ids(hpo_index, get_hpo_ids(pd.Series(criteria)))[criterion_codes]
+	rows, min_path_length, clades = join_hpo_codes(hpo_index, hpo_codes)
+	clade_data = pd.DataFrame({"patient_index": patient_codes[rows].astype(np.int32), "term_row": term_rows[term_ids[rows]], "Frequency": frequency[rows].astype(np.int32), "percentile": percentile[rows], "min_path_length": min_path_length.astype(np.float32), "clade": clades.astype(np.int32)})
+
+	return(all_terms, clade_data)
+
+
+#filter by min_freq and min/max depth (keep nans), then rank clades by average frequency (always use percentile)
+#the clade ranking only depends on these thresholds, so it is shared by every num_clades value
+def rank_clades(clade_data, min_freq=0, min_depth=0, max_depth=100):
+	if min_freq_as_percent:
+		keep = clade_data.percentile.values >= (min_freq/100)
+	else:
+		keep = clade_data.Frequency.values >= min_freq
+	min_path_length = clade_data.min_path_length.values
+	keep &= ((min_path_length >= min_depth) & (min_path_length <= max_depth)) | np.isnan(min_path_length)
+
+	#(patient, clade) pairs only group rows for the mean, so any numbering of them gives the same result
+	patient_index = clade_data.patient_index.values[keep]
+	clades = clade_data.clade.values[keep]
+	num_clade_codes = int(clades.max()) + 2 if len(clades) > 0 else 1
+	clade_frequency = group_mean(patient_index.astype(np.int64) * num_clade_codes + clades + 1, clade_data.percentile.values[keep])
+	clade_frequency_rank = pd.Series(clade_frequency).groupby(patient_index).rank(ascending=False, method="dense").values
+
+	return(pd.DataFrame({"term_row": clade_data.term_row.values[keep], "clade": clades, "clade_frequency_rank": clade_frequency_rank.astype(np.float32)}))
+
+
+#keep the top num_clades clades per patient and restore the full term list for patients with too few terms left
+#returns a boolean mask over all_terms
+def select_terms(all_terms, ranked_data, num_clades=100):
+	clade_mask = (ranked_data.clade_frequency_rank.values <= num_clades) | (ranked_data.clade.values < 0)
+	keep = np.zeros(len(all_terms), dtype=bool)
+	keep[ranked_data.term_row.values[clade_mask]] = True
+
+	#reset patients that have min_terms or fewer terms left after filtering (including patients that have been removed)
+	patient_index = all_terms.patient_index.values
+	patient_term_counts = np.bincount(patient_index[keep], minlength=patient_index[-1] + 1 if len(patient_index) > 0 else 0)
+	keep |= (patient_term_counts <= min_terms)[patient_index]
+
+	return(keep)
+
+
+#bitmask sweep output: one base term table (in output order) plus a packed bitmask per run over its rows
+def get_bitmask_filename(filename_prefix):
+	return("{}_sweep_bitmask.npz".format(filename_prefix))
+
+
+def write_bitmask(all_terms, run_masks, output_path):
+	patients, patient_index = np.unique(all_terms.Patient.values.astype(str), return_inverse=True)
+	criteria, criterion_index = np.unique(all_terms.Criterion.values.astype(str), return_inverse=True)
+	run_names = list(run_masks.keys())
+	masks = np.packbits(np.array([run_masks[run_name] for run_name in run_names], dtype=bool).reshape(len(run_names), len(all_terms)), axis=1)
+	#write through a file handle so numpy does not append .npz to the name
+	with open(output_path, "wb") as fhw:
+		np.savez_compressed(fhw, patients=patients, patient_index=patient_index.astype(np.int32), criteria=criteria, criterion_index=criterion_index.astype(np.int32), frequency=all_terms.Frequency.values.astype(np.int64), runs=np.array(run_names, dtype=str), masks=masks)
+
+
+#read a bitmask sweep file; returns the base term table and {output_filename: boolean mask over its rows}
+def read_bitmask(bitmask_path):
+	with np.load(bitmask_path, allow_pickle=False) as npz:
+		all_terms = pd.DataFrame({"Patient": npz["patients"][npz["patient_index"]].astype(object), "Criterion": npz["criteria"][npz["criterion_index"]].astype(object), "Frequency": npz["frequency"]})
+		masks = np.unpackbits(npz["masks"], axis=1, count=len(all_terms)).astype(bool)
+		run_masks = dict(zip(npz["runs"].tolist(), masks))
+	return(all_terms, run_masks)
+
+
+#write the Clinithink-format file of a single run (identified by its filtered filename) from a bitmask sweep file
+def materialize_bitmask_run(bitmask_path, output_filename, output_dir="."):
+	all_terms, run_masks = read_bitmask(bitmask_path)
+	write_patient_blocks(all_terms.loc[run_masks[output_filename]], os.path.join(output_dir, output_filename))
+	return(output_filename)
+
+
+#columnar sweep output: one Parquet file with a row group per run and columns (run, patient, hpo_id, criterion, frequency),
+#strings dictionary encoded, so any subset of runs can be loaded with predicate pushdown instead of parsing text files,
+#e.g. pandas.read_parquet(path, filters=[("run", "in", ["NLP_fp40", "NLP_c2"])])
+def get_parquet_filename(filename_prefix):
+	return("{}_sweep.parquet".format(filename_prefix))
+
+
+#pyarrow is only needed for the Parquet output
+def _import_pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.parquet
+	except ImportError:
+		raise ImportError("Parquet output of the NLP sweep requires pyarrow (pip install pyarrow)")
+	return(pyarrow, pyarrow.parquet)
+
+
+#write {runName: boolean mask over all_terms} as a Parquet sweep file (the run names are also kept in the file metadata)
+def write_parquet(all_terms, run_masks, output_path):
+	pa, pq = _import_pyarrow()
+	patient_codes, patients = pd.factorize(all_terms.Patient)
+	criterion_codes, criteria = pd.factorize(all_terms.Criterion)
+	hpo_id_codes, hpo_ids = pd.factorize(get_hpo_ids(pd.Series(criteria, dtype=object)))
+	frequency = all_terms.Frequency.values.astype(np.int64)
+
+	#run is a plain string column (still dictionary encoded in the file) since row group statistics are only used
+	#to skip row groups for filters on non-dictionary columns; the other strings are read back as dictionaries (categoricals)
+	dictionaries = {"patient": pa.array(patients.astype(str), pa.string()), "hpo_id": pa.array(hpo_ids.astype(str), pa.string()), "criterion": pa.array(criteria.astype(str), pa.string())}
+	schema = pa.schema([("run", pa.string())] + [(name, pa.dictionary(pa.int32(), pa.string())) for name in dictionaries.keys()] + [("frequency", pa.int64())], metadata={"runs": json.dumps(list(run_masks.keys()))})
+
+	with pq.ParquetWriter(output_path, schema, use_dictionary=True, compression="zstd") as writer:
+		for runName, keep in run_masks.items():
+			rows = np.flatnonzero(keep)
+			codes = {"patient": patient_codes[rows], "hpo_id": hpo_id_codes[criterion_codes[rows]], "criterion": criterion_codes[rows]}
+			columns = [pa.array(np.full(len(rows), runName, dtype=object), pa.string())] + [pa.DictionaryArray.from_arrays(codes[name].astype(np.int32), dictionary) for name, dictionary in dictionaries.items()] + [pa.array(frequency[rows])]
+			writer.write_table(pa.Table.from_arrays(columns, schema=schema), row_group_size=max(len(rows), 1))
+
+
+def read_parquet_runs(parquet_path):
+	pa, pq = _import_pyarrow()
+	return(json.loads(pq.read_schema(parquet_path).metadata[b"runs"]))
+
+
+#inputs shared with sweep worker processes; they are set before the pool is created so that the forked workers
+#inherit them instead of receiving pickled copies with every task
+_sweep_inputs = {}
+
+
+#filter patient chunk [lo, hi) of all_terms (rows are sorted by patient) for a group of runs sharing frequency/depth thresholds
+#every filter is computed per patient, so the chunk gives the same rows as filtering all patients
+#returns (seconds spent ranking clades, [(output_filename, Clinithink-format text of the chunk if text else its packed mask, seconds, rows kept)])
+def _sweep_task(task):
+	(min_freq, min_depth, max_depth), group_runs, chunk, text = task
+	lo, hi = _sweep_inputs["chunk_bounds"][chunk], _sweep_inputs["chunk_bounds"][chunk + 1]
+	all_terms = _sweep_inputs["all_terms"].iloc[lo:hi].reset_index(drop=True)
+	clade_data = _sweep_inputs["clade_data"].iloc[_sweep_inputs["chunk_rows"][chunk]]
+	clade_data = clade_data.assign(term_row=clade_data.term_row.values - lo)
+
+	start = time.perf_counter()
+	ranked_data = rank_clades(clade_data, min_freq, min_depth, max_depth)
+	rank_seconds = time.perf_counter() - start
+	results = []
+	for output_filename, num_clades in group_runs:
+		start = time.perf_counter()
+		keep = select_terms(all_terms, ranked_data, num_clades)
+		output = format_patient_blocks(all_terms.loc[keep]) if text else np.packbits(keep)
+		results.append((output_filename, output, time.perf_counter() - start, int(keep.sum())))
+	return(rank_seconds, results)
+
+
+def record_run_metrics(output_filename, params, seconds, rows):
+	min_freq, min_depth, max_depth, num_clades = params
+	record_metrics("filter_run", output_filename=output_filename, min_freq=min_freq, min_depth=min_depth, max_depth=max_depth, num_clades=num_clades, seconds=round(seconds, 4), rows=rows, rss_mb=round(rss_bytes() / 2**20, 1))
+
+
+#input bytes per patient chunk of a chunked sweep with a max_memory_mb budget
+def get_chunk_size(max_memory_mb):
+	return(max(int(max_memory_mb * 2**20 / chunk_memory_per_input_byte), 1))
+
+
+#rank and join parsed terms with the HPO depth/clade index (timed as the "hpo_index" and "prepare_terms" stages)
+def load_sweep_terms(data):
+	with stage("hpo_index"):
+		hpo_index = get_hpo_index(clade_depth_file, clades_list_file, hpo_index_dir)
+	with stage("prepare_terms") as metrics:
+		all_terms, clade_data = prepare_terms(data, hpo_index)
+		metrics.update(rows=len(all_terms), clade_rows=len(clade_data))
+	return(all_terms, clade_data)
+
+
+#results of tasks run in pool, in task order, with at most window tasks submitted ahead of the consumer (bounds the results held in memory)
+def _ordered_results(pool, tasks, window):
+	in_flight = collections.deque()
+	for task in tasks:
+		in_flight.append(pool.apply_async(_sweep_task, (task,)))
+		if len(in_flight) >= window:
+			yield in_flight.popleft().get()
+	while len(in_flight) > 0:
+		yield in_flight.popleft().get()
+
+
+#filter results of every pending run {output_filename: [min_freq, min_depth, max_depth, num_clades]}, in the order of pending's threshold groups
+#yields (output_filename, Clinithink-format text of the run if text else its boolean mask over all_terms)
+#with workers > 1 (0 for all cores) the runs are computed by a pool of forked processes, one task per threshold group and patient chunk
+#the time and rows kept of every run are recorded as "filter_run" metrics (summed over chunks; rss_mb is the parent process only)
+def compute_runs(all_terms, clade_data, pending, workers=1, text=False):
+
+	#group runs sharing frequency/depth thresholds so clades are ranked once per group
+	run_groups = {}
+	for output_filename, (min_freq, min_depth, max_depth, num_clades) in pending.items():
+		run_groups.setdefault((min_freq, min_depth, max_depth), []).append((output_filename, num_clades))
+
+	workers = workers or os.cpu_count()
+	if workers <= 1 or len(run_groups) == 0:
+		for (min_freq, min_depth, max_depth), group_runs in run_groups.items():
+			start = time.perf_counter()
+			ranked_data = rank_clades(clade_data, min_freq, min_depth, max_depth)
+			record_metrics("rank_clades", min_freq=min_freq, min_depth=min_depth, max_depth=max_depth, seconds=round(time.perf_counter() - start, 4))
+			for output_filename, num_clades in group_runs:
+				start = time.perf_counter()
+				keep = select_terms(all_terms, ranked_data, num_clades)
+				output = format_patient_blocks(all_terms.loc[keep]) if text else keep
+				record_run_metrics(output_filename, pending[output_filename], time.perf_counter() - start, int(keep.sum()))
+				yield output_filename, output
+		return
+
+	#split patients into enough chunks to give every worker ~2 tasks
+	num_patients = all_terms.patient_index.values[-1] + 1 if len(all_terms) > 0 else 0
+	num_chunks = max(1, min(num_patients, -(-2 * workers // len(run_groups))))
+	chunk_bounds = np.searchsorted(all_terms.patient_index.values, np.linspace(0, num_patients, num_chunks + 1).round().astype(int))
+	chunk_ids = np.searchsorted(chunk_bounds, clade_data.term_row.values, side="right") - 1
+	_sweep_inputs.update(all_terms=all_terms, clade_data=clade_data, chunk_bounds=chunk_bounds, chunk_rows=[np.flatnonzero(chunk_ids == chunk) for chunk in range(num_chunks)])
+
+	try:
+		tasks = [(thresholds, group_runs, chunk, text) for thresholds, group_runs in run_groups.items() for chunk in range(num_chunks)]
+		with multiprocessing.get_context("fork").Pool(min(workers, len(tasks))) as pool:
+			results = _ordered_results(pool, tasks, 2 * workers)
+			#merge the chunks of each group in order, so outputs do not depend on the number of workers
+			for (min_freq, min_depth, max_depth), group_runs in run_groups.items():
+				chunk_results = [next(results) for chunk in range(num_chunks)]
+				record_metrics("rank_clades", min_freq=min_freq, min_depth=min_depth, max_depth=max_depth, seconds=round(sum(rank_seconds for rank_seconds, runs in chunk_results), 4))
+				for run_index, (output_filename, num_clades) in enumerate(group_runs):
+					chunk_runs = [runs[run_index] for rank_seconds, runs in chunk_results]
+					record_run_metrics(output_filename, pending[output_filename], sum(run[2] for run in chunk_runs), sum(run[3] for run in chunk_runs))
+					parts = [run[1] for run in chunk_runs]
+					if text:
+						yield output_filename, "".join(parts)
+					else:
+						yield output_filename, np.concatenate([np.unpackbits(part, count=chunk_bounds[chunk + 1] - chunk_bounds[chunk]).astype(bool) for chunk, part in enumerate(parts)])
+	finally:
+		_sweep_inputs.clear()
+
+
+#output formats of a sweep: one format or a list of them, all written from the same filter pass
+sweep_output_formats = ("text", "bitmask", "parquet")
+
+
+def get_output_formats(output_format):
+	output_formats = [output_format] if isinstance(output_format, str) else list(output_format)
+	for name in output_formats:
+		if name not in sweep_output_formats:
+			raise ValueError("Unknown NLP sweep output format: {}".format(name))
+	return(output_formats)
+
+
+#run every filter combination in runs ({runName: [min_freq, min_depth, max_depth, num_clades]}) from a single parse/join of the input
+#output_format "text" writes one Clinithink-format file per run (gzipped with a .gz suffix if compress), "bitmask" writes a single bitmask sweep file (get_bitmask_filename),
+#"parquet" writes a single columnar sweep file (get_parquet_filename); a list of formats writes each of them from the same filter pass
+#without a cache_dir, outputs that already exist are not recomputed; with a cache_dir, outputs are reused from the content-addressed
+#cache only if the input file, both HPO tables, and the parameters are unchanged (cache limited to cache_max_bytes, least recently used entries are evicted)
+#workers > 1 (0 for all cores) runs the filters in a process pool (see compute_runs); outputs are the same for any number of workers
+#with max_memory_mb the cohort is streamed in chunks of patients sized to stay within about that much memory (text outputs only,
+#the single-file formats need the whole term table); outputs are the same as without it
+#returns {runName: output_filename} (the text output's filenames if text is one of the formats)
+def sweep_NLP(input_filename, runs, output_dir="UnDx_filtered_NLP_outputs", filename_prefix="UnDx_NLPoutput", output_format="text", compress=False, cache_dir=None, cache_max_bytes=None, workers=1, max_memory_mb=None):
+	output_formats = get_output_formats(output_format)
+	if max_memory_mb is not None and output_formats != ["text"]:
+		raise ValueError("Chunked NLP sweeps (max_memory_mb) only write text outputs, not {}".format(", ".join(output_formats)))
+	run_filenames = {runName: get_output_filename(filename_prefix, *params) for runName, params in runs.items()}
+	text_suffix = ".gz" if compress and "text" in output_formats else ""
+	all_runs = {run_filenames[runName]: params for runName, params in runs.items()}
+
+	if cache_dir is not None:
+		input_hashes = [file_sha256(input_filename), file_sha256(clade_depth_file), file_sha256(clades_list_file)]
+		get_run_cache_key = lambda output_format, params: get_cache_key(cache_version, input_hashes, min_freq_as_percent, min_terms, output_format, compress, params)
+
+	#outputs that still need to be computed: single-file outputs {output_format: path}, which need every run, and the runs of the text output
+	single_file_paths = {}
+	if "bitmask" in output_formats:
+		bitmask_path = os.path.join(output_dir, get_bitmask_filename(filename_prefix))
+		if cache_dir is not None:
+			complete = cache_fetch(cache_dir, get_run_cache_key("bitmask", sorted(all_runs.items())), bitmask_path)
+		else:
+			complete = os.path.exists(bitmask_path) and set(all_runs.keys()) <= set(read_bitmask(bitmask_path)[1].keys())
+		if not complete:
+			single_file_paths["bitmask"] = bitmask_path
+	if "parquet" in output_formats:
+		parquet_path = os.path.join(output_dir, get_parquet_filename(filename_prefix))
+		if cache_dir is not None:
+			complete = cache_fetch(cache_dir, get_run_cache_key("parquet", sorted(runs.items())), parquet_path)
+		else:
+			complete = os.path.exists(parquet_path) and set(runs.keys()) <= set(read_parquet_runs(parquet_path))
+		if not complete:
+			single_file_paths["parquet"] = parquet_path
+	pending = {}
+	if "text" in output_formats:
+		for run_filename, params in all_runs.items():
+			output_path = os.path.join(output_dir, run_filename + text_suffix)
+			if cache_dir is not None:
+				if cache_fetch(cache_dir, get_run_cache_key("text", params), output_path):
+					continue
+			elif os.path.exists(output_path):
+				continue
+			pending[run_filename] = params
+
+	#write (and cache) the text output of a run
+	def write_text_output(run_filename, text):
+		write_formatted_blocks(text, os.path.join(output_dir, run_filename + text_suffix), compress=compress)
+		if cache_dir is not None:
+			cache_store(cache_dir, get_run_cache_key("text", pending[run_filename]), os.path.join(output_dir, run_filename + text_suffix))
+
+	if len(pending) > 0 and max_memory_mb is not None:
+		#every filter is computed per patient, so chunks of patients (in output order) are filtered on their own and appended
+		#to each run's output; outputs are written under a temporary name and renamed once complete
+		partial_paths = {run_filename: os.path.join(output_dir, "{}{}.partial.{}".format(run_filename, text_suffix, uuid.uuid4().hex)) for run_filename in pending.keys()}
+		for partial_path in partial_paths.values():
+			write_formatted_blocks("", partial_path, compress=compress)
+		for chunk, data in enumerate(iter_sorted_patient_chunks(input_filename, get_chunk_size(max_memory_mb))):
+			record_metrics("read_terms", chunk=chunk, rows=len(data))
+			all_terms, clade_data = load_sweep_terms(data)
+			for run_filename, text in compute_runs(all_terms, clade_data, pending, workers, text=True):
+				write_formatted_blocks(text, partial_paths[run_filename], compress=compress, append=True)
+			#free the chunk before the next one is parsed
+			del all_terms, clade_data, data
+		for run_filename, partial_path in partial_paths.items():
+			os.replace(partial_path, os.path.join(output_dir, run_filename + text_suffix))
+			if cache_dir is not None:
+				cache_store(cache_dir, get_run_cache_key("text", pending[run_filename]), os.path.join(output_dir, run_filename + text_suffix))
+
+	elif len(pending) > 0 or len(single_file_paths) > 0:
+		with stage("read_terms") as metrics:
+			data = read_terms(input_filename)
+			metrics["rows"] = len(data)
+		all_terms, clade_data = load_sweep_terms(data)
+
+		if len(single_file_paths) > 0:
+			#the single-file outputs need the mask of every run; pending text outputs are formatted from the same masks
+			run_masks = {}
+			for run_filename, keep in compute_runs(all_terms, clade_data, all_runs, workers):
+				run_masks[run_filename] = keep
+				if run_filename in pending:
+					write_text_output(run_filename, format_patient_blocks(all_terms.loc[keep]))
+			if "bitmask" in single_file_paths:
+				write_bitmask(all_terms, run_masks, bitmask_path)
+				if cache_dir is not None:
+					cache_store(cache_dir, get_run_cache_key("bitmask", sorted(all_runs.items())), bitmask_path)
+			if "parquet" in single_file_paths:
+				write_parquet(all_terms, {runName: run_masks[run_filenames[runName]] for runName in runs.keys()}, parquet_path)
+				if cache_dir is not None:
+					cache_store(cache_dir, get_run_cache_key("parquet", sorted(runs.items())), parquet_path)
+		else:
+			for run_filename, text in compute_runs(all_terms, clade_data, pending, workers, text=True):
+				write_text_output(run_filename, text)
+
+	if cache_dir is not None and cache_max_bytes is not None:
+		evict_cache(cache_dir, cache_max_bytes)
+
+	return({runName: run_filename + text_suffix for runName, run_filename in run_filenames.items()})
+
+
+#content hash of each patient's (Criterion, Frequency) rows in file order, combined with context (settings, table hashes)
+def get_patient_hashes(data, context):
+	order = np.argsort(data.Patient.values, kind="stable")
+	patients = data.Patient.values[order]
+	rows = (data.Criterion.values.astype(object) + "," + data.Frequency.astype(str).values.astype(object))[order]
+	starts = np.flatnonzero(np.r_[True, patients[1:] != patients[:-1]]) if len(order) > 0 else np.array([], dtype=int)
+	ends = np.r_[starts[1:], len(order)]
+	return({patients[start]: get_cache_key(context, "\n".join(rows[start:end])) for start, end in zip(starts, ends)})
+
+
+#incremental version of sweep_NLP: every filter is computed per patient, so results are kept in shard_dir as bitmask shards
+#indexed per patient (shard_index.json maps each patient to the hash of its terms and the shard holding its results)
+#only new or changed patients are filtered, as one new shard; outputs are then reassembled from the shards
+#(shards are recomputed from scratch if the runs, HPO tables, or fixed filter settings change)
+#output_format is one format or a list of them, as in sweep_NLP
+def sweep_NLP_incremental(input_filename, runs, shard_dir, output_dir="UnDx_filtered_NLP_outputs", filename_prefix="UnDx_NLPoutput", output_format="text", compress=False, workers=1):
+	output_formats = get_output_formats(output_format)
+	output_file_map = {runName: get_output_filename(filename_prefix, *params) + (".gz" if compress and "text" in output_formats else "") for runName, params in runs.items()}
+	pending = {output_file_map[runName]: params for runName, params in runs.items()}
+	output_paths = []
+	if "bitmask" in output_formats:
+		output_paths.append(os.path.join(output_dir, get_bitmask_filename(filename_prefix)))
+	if "parquet" in output_formats:
+		parquet_path = os.path.join(output_dir, get_parquet_filename(filename_prefix))
+		output_paths.append(parquet_path)
+	if "text" in output_formats:
+		output_paths += [os.path.join(output_dir, output_filename) for output_filename in pending.keys()]
+
+	config = get_cache_key(cache_version, file_sha256(clade_depth_file), file_sha256(clades_list_file), min_freq_as_percent, min_terms, sorted(pending.items()))
+	index_path = os.path.join(shard_dir, "shard_index.json")
+	shard_index = {"config": config, "patients": {}}
+	if os.path.exists(index_path):
+		with open(index_path) as fh:
+			shard_index = json.load(fh)
+		if shard_index["config"] != config:
+			shard_index = {"config": config, "patients": {}}
+	patient_shards = shard_index["patients"]
+
+	with stage("read_terms") as metrics:
+		data = read_terms(input_filename)
+		metrics["rows"] = len(data)
+	patient_hashes = get_patient_hashes(data, config)
+	changed = sorted(patient for patient, patient_hash in patient_hashes.items() if patient_shards.get(patient, {}).get("hash") != patient_hash)
+	removed = set(patient_shards.keys()) - set(patient_hashes.keys())
+	up_to_date = all(os.path.exists(output_path) for output_path in output_paths)
+	if up_to_date and "parquet" in output_formats:
+		up_to_date = set(runs.keys()) <= set(read_parquet_runs(parquet_path))
+	if len(changed) == 0 and len(removed) == 0 and up_to_date:
+		return(output_file_map)
+
+	#filter new/changed patients on their own
+	os.makedirs(shard_dir, exist_ok=True)
+	if len(changed) > 0:
+		shard_filename = "shard_{}.npz".format(get_cache_key(config, [patient_hashes[patient] for patient in changed]))
+		all_terms, clade_data = load_sweep_terms(data.loc[data.Patient.isin(changed), :].reset_index(drop=True))
+		write_bitmask(all_terms, dict(compute_runs(all_terms, clade_data, pending, workers)), os.path.join(shard_dir, shard_filename))
+		for patient in changed:
+			patient_shards[patient] = {"hash": patient_hashes[patient], "shard": shard_filename}
+	for patient in removed:
+		del patient_shards[patient]
+
+	#merge the current rows of every shard (sorted by patient, the order terms are written in)
+	shard_patients = {}
+	for patient, entry in patient_shards.items():
+		shard_patients.setdefault(entry["shard"], []).append(patient)
+	merged_terms = []
+	merged_masks = {output_filename: [] for output_filename in pending.keys()}
+	for shard_filename in sorted(shard_patients.keys()):
+		shard_terms, shard_masks = read_bitmask(os.path.join(shard_dir, shard_filename))
+		current = shard_terms.Patient.isin(shard_patients[shard_filename]).values
+		merged_terms.append(shard_terms.loc[current, :])
+		for output_filename in pending.keys():
+			merged_masks[output_filename].append(shard_masks[output_filename][current])
+
+	all_terms = pd.concat(merged_terms, ignore_index=True) if len(merged_terms) > 0 else pd.DataFrame({"Patient": [], "Criterion": [], "Frequency": []})
+	term_order = np.argsort(all_terms.Patient.values, kind="stable")
+	all_terms = all_terms.iloc[term_order].reset_index(drop=True)
+	run_masks = {output_filename: np.concatenate(masks)[term_order] if len(masks) > 0 else np.zeros(0, dtype=bool) for output_filename, masks in merged_masks.items()}
+
+	if "bitmask" in output_formats:
+		write_bitmask(all_terms, run_masks, os.path.join(output_dir, get_bitmask_filename(filename_prefix)))
+	if "parquet" in output_formats:
+		write_parquet(all_terms, {runName: run_masks[output_file_map[runName]] for runName in runs.keys()}, parquet_path)
+	if "text" in output_formats:
+		for output_filename, keep in run_masks.items():
+			write_patient_blocks(all_terms.loc[keep], os.path.join(output_dir, output_filename), compress=compress)
+
+	#the index is only updated once every output has been written, so a refresh interrupted before then is redone by the next run
+	#(which still finds the shards of the old index, as unused shards are only removed after it is replaced)
+	tmp_index_path = "{}.tmp.{}".format(index_path, uuid.uuid4().hex)
+	with open(tmp_index_path, "w") as fhw:
+		json.dump(shard_index, fhw)
+	os.replace(tmp_index_path, index_path)
+	for shard_filename in os.listdir(shard_dir):
+		if shard_filename.startswith("shard_") and shard_filename.endswith(".npz") and shard_filename not in shard_patients:
+			os.remove(os.path.join(shard_dir, shard_filename))
+
+	return(output_file_map)
+
+
+#filter NLP list for a single parameter combination
+def filter_NLP(input_filename="UnDx_output.txt", min_freq=0, min_depth=0, max_depth=100, num_clades=100, output_dir="UnDx_filtered_NLP_outputs", filename_prefix="UnDx_NLPoutput", cache_dir=None, cache_max_bytes=None):
+	return(sweep_NLP(input_filename, {"run": [min_freq, min_depth, max_depth, num_clades]}, output_dir, filename_prefix, cache_dir=cache_dir, cache_max_bytes=cache_max_bytes)["run"])
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+##################################################
+## This module records pipeline metrics as JSON lines: wall time, row counts and peak memory (RSS) of each stage of
+## post_process_NLP.py and of each NLP filter run. Every record carries the time, a run_id shared by all records of
+## one pipeline run, and the context given to configure_metrics (e.g. the number of patients), so metrics files
+## can be appended to over time to track cohort growth. Nothing is recorded until configure_metrics is called.
+## It also has the optional cProfile/pyinstrument profiler hook used by the pipeline scripts.
+##################################################
+
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+from datetime import datetime
+
+
+page_size = os.sysconf("SC_PAGE_SIZE")
+
+_metrics = {"path": None, "run_id": None, "context": {}}
+_metrics_lock = threading.Lock()
+
+
+def rss_bytes():
+	with open("/proc/self/statm") as fh:
+		return(int(fh.read().split()[1]) * page_size)
+
+
+#peak resident memory of this process while in the with block (sampled every interval seconds)
+class MemorySampler:
+
+	def __init__(self, interval=0.005):
+		self.interval = interval
+		self.peak = 0
+		self._stop = threading.Event()
+
+	def _sample(self):
+		while not self._stop.is_set():
+			self.peak = max(self.peak, rss_bytes())
+			self._stop.wait(self.interval)
+
+	def __enter__(self):
+		self.peak = rss_bytes()
+		self._thread = threading.Thread(target=self._sample, daemon=True)
+		self._thread.start()
+		return(self)
+
+	def __exit__(self, *exc_info):
+		self._stop.set()
+		self._thread.join()
+		self.peak = max(self.peak, rss_bytes())
+
+
+#append metrics of this process to metrics_path; context fields are added to every record
+def configure_metrics(metrics_path, **context):
+	_metrics.update(path=metrics_path, run_id=uuid.uuid4().hex, context=context)
+
+
+def metrics_enabled():
+	return(_metrics["path"] is not None)
+
+
+def record_metrics(stage, **fields):
+	if _metrics["path"] is None:
+		return
+	record = dict(time=datetime.now().isoformat(timespec="seconds"), run_id=_metrics["run_id"], stage=stage, **_metrics["context"])
+	record.update(fields)
+	with _metrics_lock:
+		with open(_metrics["path"], "a") as fhw:
+			fhw.write(json.dumps(record) + "\n")
+
+
+#time a stage and record it with its peak RSS; fields set on the yielded dict (e.g. row counts) are added to the record
+@contextlib.contextmanager
+def stage(name, **fields):
+	if _metrics["path"] is None:
+		yield fields
+		return
+	with MemorySampler() as memory:
+		start = time.perf_counter()
+		yield fields
+		seconds = time.perf_counter() - start
+	record_metrics(name, seconds=round(seconds, 4), peak_rss_mb=round(memory.peak / 2**20, 1), **fields)
+
+
+#start "cprofile" or "pyinstrument" profiling of this process (None does nothing); pyinstrument is only needed when selected
+def start_profiler(profiler_name):
+	if profiler_name is None:
+		return(None)
+	if profiler_name == "cprofile":
+		import cProfile
+		profiler = cProfile.Profile()
+		profiler.enable()
+	elif profiler_name == "pyinstrument":
+		try:
+			import pyinstrument
+		except ImportError:
+			raise ImportError("The pyinstrument profiler requires pyinstrument (pip install pyinstrument)")
+		profiler = pyinstrument.Profiler()
+		profiler.start()
+	else:
+		raise ValueError("Unknown profiler: {}".format(profiler_name))
+	return(profiler)
+
+
+#stop profiling and write the profile (cProfile stats for snakeviz/pstats, or a pyinstrument html report)
+def stop_profiler(profiler, output_path):
+	if profiler is None:
+		return
+	if hasattr(profiler, "dump_stats"):
+		profiler.disable()
+		profiler.dump_stats(output_path)
+	else:
+		profiler.stop()
+		with open(output_path, "w") as fhw:
+			fhw.write(profiler.output_html())
+	print("Profile written to {}".format(output_path))
@@ -45,13 +45,14 @@ import os
 import sys
 import os.path as path
 from datetime import date
-import pandas as pd
 import re
-import boto3
 import time
 import requests
 import yaml
 import io
+from nlp_filter import sweep_NLP, sweep_NLP_incremental, get_bitmask_filename, get_parquet_filename
+from s3_transfer import get_s3_resource, fetch_objects, upload_changed_files
+from pipeline_metrics import configure_metrics, record_metrics, stage, start_profiler, stop_profiler
 
 
 #get directories/filenames from yaml (first command line argument or override the line below)
@@ -66,38 +67,59 @@ nlp_terms_filename = yaml_data["nlp_terms_filename"] #this file contains the Cli
 nlp_output_dir = yaml_data["nlp_output_dir"] #this is the local directory where the filtered lists in the same format will be stored
 nlp_hpo_filename_prefix = yaml_data["nlp_hpo_filename_prefix"] #this prefix is appended to each filtered filename
 nlp_terms_orig_dirname = yaml_data["nlp_terms_orig_dirname"] #this is the "folder" on S3 where the original raw Clinithink output is stored as individual files
+nlp_output_format = yaml_data.get("nlp_output_format", "text") #"text" writes one filtered file per run, "bitmask" writes a single base term table + per-run bitmask file
+nlp_columnar_output = yaml_data.get("nlp_columnar_output", False) #also write the whole sweep as a single Parquet file (run, patient, hpo_id, criterion, frequency), requires pyarrow
+nlp_filter_workers = yaml_data.get("nlp_filter_workers", 1) #number of processes the filter sweep runs in (0 for all cores)
+nlp_filter_max_memory_mb = yaml_data.get("nlp_filter_max_memory_mb") #if set, the text sweep streams the cohort in patient chunks sized to about this much memory per process
+nlp_filter_cache_dir = yaml_data.get("nlp_filter_cache_dir") #shared local directory caching filtered outputs by input/parameter hashes (disabled if not set)
+nlp_filter_cache_max_bytes = int(yaml_data.get("nlp_filter_cache_max_gb", 10) * 1024**3) #size limit of the filter cache, least recently used entries are evicted
+nlp_shard_dir = yaml_data.get("nlp_shard_dir") #local directory of per-patient filter results; if set only new or changed patients are filtered on each run
 
 s3_bucket_name = yaml_data["s3_bucket_name"]
+s3_fetch_concurrency = yaml_data.get("s3_fetch_concurrency", 16) #number of per-patient Clinithink files downloaded in parallel
+s3_max_retries = yaml_data.get("s3_max_retries", 5) #number of times a transient S3 error is retried
+s3_upload_manifest = yaml_data.get("s3_upload_manifest", "s3_upload_manifest.json") #local manifest of uploaded content hashes (relative to workdir), used to skip unchanged uploads
+
+metrics_file = yaml_data.get("metrics_file") #JSON lines file (relative to workdir) that per-stage and per-run metrics are appended to (disabled if not set)
+profiler_name = yaml_data.get("profiler") #"cprofile" or "pyinstrument" to profile the whole run (disabled if not set)
+profile_output = yaml_data.get("profile_output", "post_process_NLP.prof") #profile output (relative to workdir)
 
 #set working directory, create it if it does not exist
 os.makedirs(workdir, exist_ok=True)
 os.chdir(workdir)
 
+start_time = time.time()
+profiler = start_profiler(profiler_name)
 
-s3 = boto3.resource('s3')
+s3 = get_s3_resource()
 
 #get individual nlp hpo files from S3, concatenate them and upload combined file back to S3
 #first map csv filenames to vcf file names 
 vcf_files = yaml_data['vcf_files'] #assume 1-to-1 matching
+if metrics_file:
+	configure_metrics(metrics_file, script="post_process_NLP.py", patients=len(vcf_files), nlp_output_format=nlp_output_format, nlp_filter_workers=nlp_filter_workers)
 key_map = dict(zip([nlp_terms_orig_dirname + "/" + re.match("s3.+MAN_(\d+-01).+\.vcf", vcf_file).groups()[0]+".csv" for vcf_file in vcf_files], [re.match("s3.+(MAN_.+)\.vcf", vcf_file).groups()[0] for vcf_file in vcf_files]))
 
-fhw = open(nlp_terms_filename, "w")
-for NLP_csv_filename in key_map.keys():
-	#read in data
-	obj = s3.meta.client.get_object(Bucket=s3_bucket_name, Key=NLP_csv_filename)
-	df = obj['Body'].read().decode()
-	#replace uppercase HP with lowercase HP for consistency with previous formats and docker app requirements
-	df = re.sub("\nHP", "\nhp", df)
-	fhw.write("{}\n{}".format(key_map[NLP_csv_filename], df))
-fhw.close()	
+with stage("fetch_terms", objects=len(key_map)) as metrics:
+	fhw = open(nlp_terms_filename, "w")
+	#read in data concurrently (entries are still written in key_map order)
+	for NLP_csv_filename, df in fetch_objects(s3.meta.client, s3_bucket_name, key_map.keys(), concurrency=s3_fetch_concurrency, max_retries=s3_max_retries):
+		df = df.decode()
+		#replace uppercase HP with lowercase HP for consistency with previous formats and docker app requirements
+		df = re.sub("\nHP", "\nhp", df)
+		fhw.write("{}\n{}".format(key_map[NLP_csv_filename], df))
+	fhw.close()	
+	metrics["bytes"] = os.path.getsize(nlp_terms_filename)
 
 
-#upload combined nlp hpo file to S3
-s3.Bucket(s3_bucket_name).upload_file(os.path.join(workdir, nlp_terms_filename), nlp_terms_filename)
+#upload combined nlp hpo file to S3 (skipped if unchanged)
+with stage("upload_terms") as metrics:
+	metrics["uploaded"] = len(upload_changed_files(s3.meta.client, s3_bucket_name, {os.path.join(workdir, nlp_terms_filename): nlp_terms_filename}, s3_upload_manifest, max_retries=s3_max_retries))
 
 #get hpo summary files
-s3.Bucket(s3_bucket_name).download_file("hpo_multishortest_paths_stats.csv", os.path.join(workdir, "hpo_multishortest_paths_stats.csv"))
-s3.Bucket(s3_bucket_name).download_file("hpo_multishortest_paths.csv", os.path.join(workdir, "hpo_multishortest_paths.csv"))
+with stage("download_hpo_tables"):
+	s3.Bucket(s3_bucket_name).download_file("hpo_multishortest_paths_stats.csv", os.path.join(workdir, "hpo_multishortest_paths_stats.csv"))
+	s3.Bucket(s3_bucket_name).download_file("hpo_multishortest_paths.csv", os.path.join(workdir, "hpo_multishortest_paths.csv"))
 
 
 
@@ -435,101 +457,30 @@ run_map = {
 }
 
 
-#Step 1: Filter NLP list and upload filtered NLP output to S3
-def filter_NLP(input_filename = "UnDx_output.txt", min_freq=0, min_depth=0, max_depth=100, num_clades=100, output_dir="UnDx_filtered_NLP_outputs", filename_prefix="UnDx_NLPoutput"):
-
-	#fixed parameters that can be adjusted later
-	min_freq_as_percent = True      
-	min_terms = 5
-	clade_depth_file = "hpo_multishortest_paths_stats.csv" 
-	clades_list_file = "hpo_multishortest_paths.csv" 
-	
-	output_filename = "{}_minfreq{}{}_mindepth{}_maxdepth{}_numclades{}.txt".format(filename_prefix, "percent" if min_freq_as_percent else "", min_freq, min_depth, max_depth, num_clades)
-	if os.path.exists(os.path.join(output_dir, output_filename)):
-		return(output_filename)
-	
-	fh = open(input_filename)
-	data = []
-	for line in fh:
-		line = line.strip().split(",")
-		if len(line) == 1:
-			key = line[0]
-		elif line[0] == "Criterion":
-			pass
-		else:
-			data.append([key, line[0], int(line[1])])
-
-	fh.close()
-
-	data = pd.DataFrame(data, columns=["Patient", "Criterion", "Frequency"])
-
-	#compute percentile frequency per patient
-	data["percentile"] = data.groupby("Patient").Frequency.transform(lambda x: x.rank() / len(x))     
-
-	#merge with clade/depth data
-	data.loc[:, "HPO_ID"] = data["Criterion"].apply(lambda x: x.split("_")[0].replace("hp", "HP:"))
-	clade_depth_data = pd.read_csv(clade_depth_file)
-	clades_list_data = pd.read_csv(clades_list_file) #clades list expanded for easier merging
-	data = data.join(clade_depth_data.set_index("HPO_ID"), how="left", on="HPO_ID")
-
-
-	#filter by min_freq
-	if min_freq_as_percent:
-		data_to_keep = data.loc[data["percentile"] >= (min_freq/100), :].copy()
-	else:
-		data_to_keep = data.loc[data["Frequency"] >= min_freq, :].copy()
-
-
-	#filter by min and max depth (keep nans)
-	data_to_keep = data_to_keep.loc[((data_to_keep.min_path_length.notna()) & (data_to_keep.min_path_length >= min_depth) & (data_to_keep.min_path_length <= max_depth)) | data_to_keep["min_path_length"].isna(), :]
-
-	#filter by top clades sorted by average frequency (always use percentile)
-	#first set nan clades to "unknown"
-	data_to_keep = data_to_keep.join(clades_list_data.set_index("HPO_ID"), how="left", on="HPO_ID", lsuffix="", rsuffix="_2")
-	data_to_keep.loc[data_to_keep.root_phenos_2.isna(), "root_phenos_2"] = "unknown"
-	data_to_keep["clade_frequency"] = data_to_keep.groupby(["Patient", "root_phenos_2"]).percentile.transform(lambda x: x.mean())
-	data_to_keep["clade_frequency_rank"] = data_to_keep.groupby(["Patient"]).clade_frequency.transform(lambda x: x.rank(ascending=False, method="dense"))
-	data_to_keep = data_to_keep.loc[((data_to_keep.root_phenos_2 != "unknown") & (data_to_keep.clade_frequency_rank <= num_clades)) | data_to_keep.root_phenos_2.eq("unknown"), :]
-	data_to_keep = data_to_keep[data_to_keep.columns.drop(list(data_to_keep.filter(regex='_2$')))]
-	data_to_keep = data_to_keep[["Patient", "Criterion", "Frequency"]].drop_duplicates()
-	#13901 rows
-
-
-	#check which patients have fewer than min_terms left after filtering
-	data = data[["Patient", "Criterion", "Frequency"]].drop_duplicates()
-	patient_term_counts = data_to_keep.groupby("Patient").Patient.count() 
-	patients_to_reset = patient_term_counts[patient_term_counts <= min_terms].index.to_list()
-	#add patients that have been removed
-	patients_to_reset = list((set(data.Patient) - set(data_to_keep.Patient)).union(set(patients_to_reset)))
-
-	#first drop patients to reset
-	data_to_keep = data_to_keep.loc[data_to_keep.Patient.isin(patients_to_reset) != True,:] #13849 rows (22 and 30 rows to be replaced with 46 and 67 rows respectively)
-	#next add new rows from original dataset
-	data_to_keep = data_to_keep.append(data.loc[data.Patient.isin(patients_to_reset),:]) #13962 rows
-
-
-	#write out filtered data
-	#group by patient
-
-	fhw = open(os.path.join(output_dir, output_filename), "w")
-	for name, group in data_to_keep.groupby("Patient"):
-		fhw.write("{}\nCriterion,Frequency\n".format(name))
-		for ind, row in group.iterrows():
-			fhw.write("{},{}\n".format(row.Criterion, row.Frequency))
-
-	fhw.close()
-
-	return(output_filename)
-
-
 #create directory to store filtered nlp outputs if it does not exist
 os.makedirs(nlp_output_dir, exist_ok=True)	
-#run filter nlp for all runs
-nlp_output_file_map = {runName: filter_NLP(input_filename = nlp_terms_filename, min_freq=run_map[runName][1], min_depth=run_map[runName][2], max_depth=run_map[runName][3], num_clades=run_map[runName][4], output_dir=nlp_output_dir, filename_prefix=nlp_hpo_filename_prefix) for runName in run_map.keys() if run_map[runName][0] == "NLP"}
-
-#upload to S3
-nlp_output_files = list(nlp_output_file_map.values())
-for nlp_output_file in nlp_output_files:
-	s3.Bucket(s3_bucket_name).upload_file(os.path.join(nlp_output_dir, nlp_output_file), nlp_output_file)
+#Step 1: Filter NLP list for all runs (input is parsed and joined once for the whole sweep) and upload filtered NLP output to S3
+nlp_runs = {runName: run_map[runName][1:] for runName in run_map.keys() if run_map[runName][0] == "NLP"}
+#the Parquet copy of the sweep is written from the same filter pass (it needs the whole term table, so the text sweep is not chunked then)
+nlp_output_formats = [nlp_output_format] + (["parquet"] if nlp_columnar_output else [])
+with stage("nlp_sweep", runs=len(nlp_runs), output_format="+".join(nlp_output_formats)):
+	if nlp_shard_dir:
+		nlp_output_file_map = sweep_NLP_incremental(input_filename = nlp_terms_filename, runs=nlp_runs, shard_dir=nlp_shard_dir, output_dir=nlp_output_dir, filename_prefix=nlp_hpo_filename_prefix, output_format=nlp_output_formats, workers=nlp_filter_workers)
+	else:
+		nlp_output_file_map = sweep_NLP(input_filename = nlp_terms_filename, runs=nlp_runs, output_dir=nlp_output_dir, filename_prefix=nlp_hpo_filename_prefix, output_format=nlp_output_formats, cache_dir=nlp_filter_cache_dir, cache_max_bytes=nlp_filter_cache_max_bytes, workers=nlp_filter_workers, max_memory_mb=None if nlp_columnar_output else nlp_filter_max_memory_mb)
+
+#upload to S3 (in bitmask mode individual run files can be materialized from the bitmask file with nlp_filter.materialize_bitmask_run)
+if nlp_output_format == "bitmask":
+	nlp_output_files = [get_bitmask_filename(nlp_hpo_filename_prefix)]
+else:
+	nlp_output_files = list(nlp_output_file_map.values())
+if nlp_columnar_output:
+	nlp_output_files.append(get_parquet_filename(nlp_hpo_filename_prefix))
+#only new or changed files are transferred
+with stage("upload_outputs", files=len(nlp_output_files)) as metrics:
+	metrics["uploaded"] = len(upload_changed_files(s3.meta.client, s3_bucket_name, {os.path.join(nlp_output_dir, nlp_output_file): nlp_output_file for nlp_output_file in nlp_output_files}, s3_upload_manifest, concurrency=s3_fetch_concurrency, max_retries=s3_max_retries))
+
+record_metrics("total", seconds=round(time.time() - start_time, 4))
+stop_profiler(profiler, profile_output)
 	
 
@@ -4,6 +4,25 @@
 ## This is a helper script to parallelize the containerized exomiser runs needed for the gene prioritization pipeline using Ray
 ## It takes as input the set of VCF and HPO files to be processed, assumes that the HPO files have a user-defined prefix, and
 ## that docker is available. A set of initial instructions for after the first time the docker image is pulled can be found commented out below
+## The containers run exomiser_image, which must be built from this repository's Dockerfile (see README.md) on every node
+## Exomiser only sees the VCF and the patient's HPO term list, and many filter combinations give a patient the same list,
+## so exomiser is run once per distinct (VCF, HPO term list) and the results are copied to the folders of the other runs
+## With exomiser_workers set, the runs are put in a job queue (job_queue.py) that long-lived exomiser containers work through,
+## instead of starting a container per run (the queue directory must be on a filesystem shared by the Ray nodes)
+## Each task asks Ray for the memory of its JVM (exomiser_Xmx plus exomiser_memory_overhead_mb), so nodes are packed by memory
+## as well as CPUs, and waits before starting its container until the node has that memory free (job_resources.py)
+## The state of every run is appended to a manifest (run_manifest.py); with exomiser_resume set, runs recorded as succeeded
+## for the same inputs (VCF, base yml and patient term list) whose results are on S3 are skipped, so an interrupted run can be restarted
+## Run times recorded in the manifest fit a model of run time on VCF size and HPO term count (runtime_model.py) that gives the
+## expected runtime (and the job slots needed for exomiser_target_hours) before the sweep, and a live ETA while it runs
+## Runs are started longest (estimated) first, largest VCF and most HPO terms first among equal estimates, so long runs do not
+## finish alone at the end of the sweep, with at most exomiser_max_in_flight runs submitted to Ray at a time
+## With exomiser_vcf_cache_gb set, the containers of a node share a VCF cache (a docker volume) and every run of a VCF is preferably
+## placed on one node chosen for the VCF before its runs are submitted, so each VCF is mostly downloaded once instead of once per run
+## With exomiser_two_phase set, the variant filters of the base yml are run once per VCF (run_exomiser_job.py in prefilter mode) and the
+## runs of its HPO term lists use the VCF of the variants that passed them, kept on S3 under exomiser_prefiltered/ for later sweeps
+## The base yml and HPO files are read from S3 once by the driver and handed to the tasks through Ray's object store; each task writes
+## its inputs to a directory on its node (exomiser_input_dir, keyed by content hash) that the containers copy them from
 ## 
 ## This script was written to support the following paper
 ## "Parikh JR, Genetti CA et al.  A data-driven architecture using natural language processing to improve phenotyping efficiency and accelerate genetic diagnoses of rare disorders."
@@ -15,10 +34,21 @@
 ##################################################
 
 import ray
+from ray.util.scheduling_strategies import NodeAffinitySchedulingStrategy
 import time
 import os
 import yaml
 import sys
+import io
+import hashlib
+import concurrent.futures
+from s3_transfer import get_s3_resource, fetch_objects, get_object_body, head_object, copy_object
+from file_cache import get_cache_path, cache_store_bytes, evict_cache
+from clinithink_format import read_patient_blocks, split_patients, get_hpo_ids
+from job_queue import create_queue, enqueue_jobs, close_queue, get_done_jobs, fail_jobs
+from job_resources import get_job_resources, get_docker_call, wait_for_memory, is_oom_exit
+from run_manifest import get_fingerprint, read_manifest_records, load_manifest, record_runs, is_run_complete
+from runtime_model import get_job_features, fit_runtime_model, predict_seconds, estimate_hours, get_slots_needed, SweepProgress
 
 
 
@@ -34,6 +64,26 @@ manual_hpo_filename = yaml_data["manual_hpo_filename"] #this prefix is appended
 
 s3_bucket_name = yaml_data["s3_bucket_name"] #s3 bucket where VCF and HPO files (not nested in "directories") can be found and where output are to be written
 
+exomiser_workers = yaml_data.get("exomiser_workers", 0) #number of long-lived exomiser containers taking runs from a job queue (0 starts a container per run)
+exomiser_batch_size = yaml_data.get("exomiser_batch_size", 1) #number of runs a worker gives to one exomiser process
+exomiser_queue_dir = os.path.abspath(yaml_data.get("exomiser_queue_dir", "exomiser_job_queue")) #job queue directory bind mounted into the workers
+
+exomiser_Xmx = yaml_data.get("exomiser_Xmx", "4g") #JVM heap of each exomiser run
+exomiser_memory_overhead_mb = yaml_data.get("exomiser_memory_overhead_mb", 1536) #memory of a job beyond the heap (JVM non-heap memory and the python wrapper)
+exomiser_min_free_memory_mb = yaml_data.get("exomiser_min_free_memory_mb", 2048) #memory a node keeps free; containers are not started while less than this plus the job's memory is available
+exomiser_launch_interval = yaml_data.get("exomiser_launch_interval", 2) #seconds between container starts on a node, so each JVM's memory shows up before the next start is checked
+job_resources = get_job_resources(exomiser_Xmx, exomiser_memory_overhead_mb)
+
+exomiser_manifest = yaml_data.get("exomiser_manifest", "exomiser_manifest.jsonl") #file the state of every exomiser run is appended to
+exomiser_resume = yaml_data.get("exomiser_resume", False) #skip runs the manifest has as succeeded for the same inputs and whose results are on S3
+exomiser_target_hours = yaml_data.get("exomiser_target_hours") #if set, also print the number of job slots needed to finish in this many hours
+exomiser_max_in_flight = yaml_data.get("exomiser_max_in_flight", 0) #most runs submitted to Ray and not finished at a time (0 is twice the number of runs the cluster runs at once)
+exomiser_vcf_cache_gb = yaml_data.get("exomiser_vcf_cache_gb", 0) #size of the node-local VCF cache shared by a node's containers (0 downloads the VCF for every run)
+exomiser_two_phase = yaml_data.get("exomiser_two_phase", False) #filter each VCF's variants once and run the HPO term lists on the variants that passed
+exomiser_input_dir = yaml_data.get("exomiser_input_dir", "/tmp/exomiser_inputs") #directory on each node the base yml and HPO files are written to for the containers
+exomiser_input_cache_gb = yaml_data.get("exomiser_input_cache_gb", 10) #size of the input directory beyond which the least recently used inputs are removed
+exomiser_image = yaml_data.get("exomiser_image", "exomiser-pipeline:12.1.0__hg19_2003__pheno_2003") #docker image built from this repository's Dockerfile (it has run_exomiser_job.py and the modules it imports)
+
 #get list of vcf files
 vcf_files = yaml_data['vcf_files']
 
@@ -376,25 +426,301 @@ jobs = [(dir_name, hpo_files[dir_name], vcf_file) for dir_name in hpo_files.keys
 #add manual jobs
 jobs = jobs + [("Manual", "s3://{}/{}".format(s3_bucket_name, manual_hpo_filename), vcf_file) for vcf_file in vcf_files]
 
+#HPO term list exomiser gets for each patient in a Clinithink-format file (as parsed in run_exomiser_job.py)
+def get_patient_term_lists(text):
+	data = read_patient_blocks(io.StringIO(text))
+	data["hpo_id"] = get_hpo_ids(data.Criterion)
+	return({patient: tuple(patient_terms.hpo_id) for patient, patient_terms in split_patients(data)})
+
+
+#group jobs with the same VCF and patient term list; the first job of each group runs exomiser and the other run folders get copies of its results
+#(patients missing from an HPO file get None, so their jobs still run, and fail, once)
+s3 = get_s3_resource()
+hpo_keys = {hpo_file: hpo_file.replace("s3://{}/".format(s3_bucket_name), "") for dir_name, hpo_file, vcf_file in jobs}
+input_bodies = {hpo_file: body for hpo_file, (key, body) in zip(hpo_keys.keys(), fetch_objects(s3.meta.client, s3_bucket_name, hpo_keys.values()))}
+term_lists = {hpo_file: get_patient_term_lists(body.decode()) for hpo_file, body in input_bodies.items()}
+
+job_groups = {}
+for dir_name, hpo_file, vcf_file in jobs:
+	sample_id = os.path.splitext(os.path.basename(vcf_file))[0]
+	job_groups.setdefault((vcf_file, term_lists[hpo_file].get(sample_id)), []).append((dir_name, hpo_file))
+unique_jobs = [(group[0][0], group[0][1], vcf_file, [dir_name for dir_name, hpo_file in group[1:]]) for (vcf_file, term_list), group in job_groups.items()]
+print("{} exomiser runs for {} jobs ({} with a term list already run for the same VCF)".format(len(unique_jobs), len(jobs), len(jobs) - len(unique_jobs)))
+
+
+job_prefix = "" #optionally set this to add a prefix to the default output directory name
+base_yml_file = "s3://{}/test-analysis-exome.yml".format(s3_bucket_name)
+input_bodies[base_yml_file] = get_object_body(s3.meta.client, s3_bucket_name, base_yml_file.replace("s3://{}/".format(s3_bucket_name), ""))
+input_keys = {s3_file: hashlib.sha256(body).hexdigest() for s3_file, body in input_bodies.items()} #key of each input in the nodes' input directories
+
+#fingerprint of the inputs of each run (VCF and base yml ETags and the patient's term list), shared by the run folders that get copies of its results,
+#and the run's features for the runtime model
+input_heads = {s3_file: head_object(s3.meta.client, s3_bucket_name, s3_file.replace("s3://{}/".format(s3_bucket_name), "")) or {} for s3_file in vcf_files + [base_yml_file]}
+fingerprints = {}
+job_features = {}
+for (vcf_file, term_list), group in job_groups.items():
+	fingerprints[(group[0][0], vcf_file)] = get_fingerprint({"vcf_file": vcf_file, "vcf_etag": input_heads[vcf_file].get("ETag"), "base_yml_etag": input_heads[base_yml_file].get("ETag"), "hpo_ids": term_list})
+	job_features[(group[0][0], vcf_file)] = get_job_features(input_heads[vcf_file].get("ContentLength", 0), len(term_list or ()))
+
+#estimated run time of each run from the run times recorded in the manifest
+manifest = load_manifest(exomiser_manifest)
+runtime_model = fit_runtime_model(read_manifest_records(exomiser_manifest))
+estimated_seconds = {job_key: predict_seconds(runtime_model, features) for job_key, features in job_features.items()}
+if runtime_model is None:
+	print("Estimating {:.0f} min per exomiser run (fewer than 10 timed runs in {})".format(predict_seconds(None, None) / 60, exomiser_manifest))
+else:
+	print("Estimating exomiser run times from {} timed runs in {}".format(runtime_model["runs"], exomiser_manifest))
+
+
+#(job_id, sample_id, fingerprint) of the result folders of a run
+def get_run_folders(dir_name, vcf_file, copy_dir_names):
+	sample_id = os.path.splitext(os.path.basename(vcf_file))[0]
+	return([(job_prefix + run_dir_name, sample_id, fingerprints[(dir_name, vcf_file)]) for run_dir_name in [dir_name] + copy_dir_names])
+
+
+def has_results(job_id, sample_id):
+	return(all(head_object(s3.meta.client, s3_bucket_name, "exomiser_results/{}/{}/{}.{}".format(job_id, extension, sample_id, extension)) is not None for extension in ["html", "json", "tab"]))
+
+
+#skip runs whose result folders are all recorded as succeeded for the same inputs and still have their results on S3
+if exomiser_resume:
+	recorded_jobs = [job for job in unique_jobs if all(is_run_complete(manifest, *run_folder) for run_folder in get_run_folders(job[0], job[2], job[3]))]
+	with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+		complete = list(executor.map(lambda job: all(has_results(job_id, sample_id) for job_id, sample_id, fingerprint in get_run_folders(job[0], job[2], job[3])), recorded_jobs))
+	complete_jobs = set(job[0] + "/" + job[2] for job, job_complete in zip(recorded_jobs, complete) if job_complete)
+	unique_jobs = [job for job in unique_jobs if job[0] + "/" + job[2] not in complete_jobs]
+	print("Resuming from {}: {} exomiser runs already complete, {} to run".format(exomiser_manifest, len(complete_jobs), len(unique_jobs)))
+
+
+#copy the html/json/tab results of a sample from one job folder to others on S3 (creating their folders like run_exomiser_job.py)
+def copy_results(job_id, copy_job_ids, sample_id):
+	client = get_s3_resource().meta.client
+	for copy_job_id in copy_job_ids:
+		if head_object(client, s3_bucket_name, "exomiser_results/" + copy_job_id + "/") is None:
+			for folder in ["", "html/", "json/", "tab/"]:
+				client.put_object(Bucket=s3_bucket_name, Key="exomiser_results/" + copy_job_id + "/" + folder)
+		for extension in ["html", "json", "tab"]:
+			copy_object(client, s3_bucket_name, "exomiser_results/{}/{}/{}.{}".format(job_id, extension, sample_id, extension), "exomiser_results/{}/{}/{}.{}".format(copy_job_id, extension, sample_id, extension))
+
+
 #initialize multiprocessing
 #ray.init(num_cpus=110, memory=(110*4*1024*1024*1024 + 50))
 ray.init()
 
+#the base yml and HPO files, put in the object store once and fetched by each node from there
+input_refs = {s3_file: ray.put(body) for s3_file, body in input_bodies.items()}
+del input_bodies
 
-job_prefix = "" #optionally set this to add a prefix to the default output directory name
-@ray.remote
-def f(dir_name, hpo_file, vcf_file, maxretries=30):
-	job_call = "docker run --mount source=exomiser-data,target=/usr/share/applications/exomiser-cli-12.1.0/data,readonly --rm -e exomiser_job_id={}{} -e exomiser_vcf_file={} -e exomiser_hpo_file={} -e exomiser_base_yml_file=s3://{}/test-analysis-exome.yml -e exomiser_Xmx=4g -e write_bucket={} -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY jiggyjsq/exomiser:12.1.0__hg19_2003__pheno_2003 python3.8 run_exomiser_job.py > out".format(job_prefix, dir_name, vcf_file, hpo_file, s3_bucket_name, s3_bucket_name)
-	for i in range(maxretries): #keep trying maxretries times or until job successfully completes (exit code 0)
-		job_code = os.system(job_call)
+
+#write inputs (S3 path: body) to this node's input directory unless they are already there, then evict the least recently used
+def write_inputs(inputs):
+	for s3_file, body in inputs.items():
+		entry_path = get_cache_path(exomiser_input_dir, input_keys[s3_file])
+		if os.path.exists(entry_path):
+			os.utime(entry_path)
+		else:
+			cache_store_bytes(exomiser_input_dir, input_keys[s3_file], body)
+	evict_cache(exomiser_input_dir, exomiser_input_cache_gb * 2**30)
+
+
+#keep trying maxretries times or until the container successfully completes (exit code 0); every start waits for the node to have the
+#job's memory free, and containers killed for running out of memory (their --memory limit, the task's Ray memory) are started again
+#(up to maxretries times) without using up a try
+#returns the exit status and the run time of the last try
+def run_container(call, maxretries=30):
+	tries = 0
+	oom_kills = 0
+	while tries < maxretries:
+		wait_for_memory(job_resources["memory"], exomiser_min_free_memory_mb * 2**20, launch_interval=exomiser_launch_interval)
+		start = time.time()
+		job_code = os.system(call)
+		seconds = time.time() - start
 		if job_code == 0:
 			break
-	return
+		if is_oom_exit(job_code) and oom_kills < maxretries:
+			oom_kills += 1
+			print("Container killed for running out of memory, restarting once memory is free: {}".format(call))
+		else:
+			tries += 1
+	return(job_code, seconds)
+
+
+#docker arguments mounting the node's input directory (the job's input keys are added per container)
+input_args = "--mount type=bind,source={},target=/usr/share/inputs -e exomiser_input_dir=/usr/share/inputs ".format(exomiser_input_dir)
+
+#docker arguments mounting the node's VCF cache volume
+vcf_cache_args = ""
+if exomiser_vcf_cache_gb > 0:
+	vcf_cache_args = "--mount source=exomiser-vcf-cache,target=/usr/share/vcf_cache -e exomiser_vcf_cache_dir=/usr/share/vcf_cache -e exomiser_vcf_cache_gb={} ".format(exomiser_vcf_cache_gb)
+
+
+#returns the exit status and run time of the run (exit status 1 if its results could not be copied to copy_dir_names)
+@ray.remote(**job_resources)
+def f(dir_name, hpo_file, vcf_file, hpo_body, base_yml_body, copy_dir_names=[], maxretries=30):
+	write_inputs({hpo_file: hpo_body, base_yml_file: base_yml_body})
+	job_call = get_docker_call(exomiser_image, "--mount source=exomiser-data,target=/usr/share/applications/exomiser-cli-12.1.0/data,readonly {}{}--rm -e exomiser_job_id={}{} -e exomiser_vcf_file={} -e exomiser_hpo_file={} -e exomiser_hpo_input={} -e exomiser_base_yml_file={} -e exomiser_base_yml_input={} -e exomiser_Xmx={} -e write_bucket={} -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY".format(input_args, vcf_cache_args, job_prefix, dir_name, vcf_file, hpo_file, input_keys[hpo_file], base_yml_file, input_keys[base_yml_file], exomiser_Xmx, s3_bucket_name), "python3.8 run_exomiser_job.py > out", job_resources["memory"])
+	job_code, seconds = run_container(job_call, maxretries)
+	#fan the results out to the runs that share this job's term list; if that fails the job is failed, so its runs are recorded
+	#as failed and run again by a resumed sweep instead of being left without results
+	if job_code == 0 and len(copy_dir_names) > 0:
+		try:
+			copy_results(job_prefix + dir_name, [job_prefix + copy_dir_name for copy_dir_name in copy_dir_names], os.path.splitext(os.path.basename(vcf_file))[0])
+		except Exception as e:
+			print("Could not copy the results of {} to {}: {}".format(job_prefix + dir_name, ", ".join(copy_dir_names), e))
+			job_code = 1
+	return(job_code, seconds)
+
+
+#long-lived exomiser container running queued jobs until the queue is drained (restarted with the same worker ID, which puts back its unfinished jobs, if it stops;
+#once it has failed maxretries times the driver fails the jobs it still has claimed)
+#input_bodies are the bodies of input_files, written to the node's input directory for the worker's jobs
+@ray.remote(**job_resources)
+def exomiser_worker(worker_id, input_files, *input_bodies, maxretries=30):
+	write_inputs(dict(zip(input_files, input_bodies)))
+	worker_call = get_docker_call(exomiser_image, "--mount source=exomiser-data,target=/usr/share/applications/exomiser-cli-12.1.0/data,readonly --mount type=bind,source={},target=/usr/share/queue {}{}--rm -e exomiser_job_queue=/usr/share/queue -e exomiser_worker_id={} -e exomiser_batch_size={} -e exomiser_Xmx={} -e write_bucket={} -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY".format(exomiser_queue_dir, input_args, vcf_cache_args, worker_id, exomiser_batch_size, exomiser_Xmx, s3_bucket_name), "python3.8 run_exomiser_job.py > out_{}".format(worker_id), job_resources["memory"])
+	return(run_container(worker_call, maxretries))
+
+
+copy_results_task = ray.remote(copy_results)
+
+
+#run the variant filters of the base yml on a VCF and write the variants that passed them to prefiltered_vcf_file; returns the exit status
+@ray.remote(**job_resources)
+def prefilter(vcf_file, prefiltered_vcf_file, base_yml_body, maxretries=30):
+	write_inputs({base_yml_file: base_yml_body})
+	prefilter_call = get_docker_call(exomiser_image, "--mount source=exomiser-data,target=/usr/share/applications/exomiser-cli-12.1.0/data,readonly {}{}--rm -e exomiser_prefilter_vcf_file={} -e exomiser_vcf_file={} -e exomiser_base_yml_file={} -e exomiser_base_yml_input={} -e exomiser_Xmx={} -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY".format(input_args, vcf_cache_args, prefiltered_vcf_file, vcf_file, base_yml_file, input_keys[base_yml_file], exomiser_Xmx), "python3.8 run_exomiser_job.py > out_prefilter", job_resources["memory"])
+	return(run_container(prefilter_call, maxretries)[0])
+
+
+#VCF each run's exomiser job is given: in a two-phase sweep the VCF's prefiltered variants, filtered once per VCF and base yml
+#(reused from earlier sweeps while both are unchanged), or the VCF itself if it could not be prefiltered
+run_vcf_files = {vcf_file: vcf_file for vcf_file in vcf_files}
+if exomiser_two_phase:
+	prefiltered_vcf_files = {vcf_file: "s3://{}/exomiser_prefiltered/{}/{}".format(s3_bucket_name, get_fingerprint({"vcf_etag": input_heads[vcf_file].get("ETag"), "base_yml_etag": input_heads[base_yml_file].get("ETag")})[:16], os.path.basename(vcf_file)) for vcf_file in set(job[2] for job in unique_jobs)}
+	prefiltered_heads = {vcf_file: head_object(s3.meta.client, s3_bucket_name, prefiltered_vcf_file.replace("s3://{}/".format(s3_bucket_name), "")) for vcf_file, prefiltered_vcf_file in prefiltered_vcf_files.items()}
+	prefilter_refs = {prefilter.remote(vcf_file, prefiltered_vcf_file, input_refs[base_yml_file]): vcf_file for vcf_file, prefiltered_vcf_file in prefiltered_vcf_files.items() if prefiltered_heads[vcf_file] is None}
+	print("Prefiltering {} VCFs ({} already prefiltered)...".format(len(prefilter_refs), len(prefiltered_vcf_files) - len(prefilter_refs)))
+	start = time.time()
+	for ref, vcf_file in prefilter_refs.items():
+		#a prefilter task that raised or died (RayTaskError, or its worker or node lost) counts as a failed prefilter
+		try:
+			job_code = ray.get(ref)
+		except ray.exceptions.RayError as e:
+			print("Prefilter task of {} failed: {}".format(vcf_file, e))
+			job_code = None
+		if job_code == 0:
+			prefiltered_heads[vcf_file] = head_object(s3.meta.client, s3_bucket_name, prefiltered_vcf_files[vcf_file].replace("s3://{}/".format(s3_bucket_name), ""))
+		else:
+			print("Could not prefilter {}, its runs use the whole VCF".format(vcf_file))
+	print("Prefiltered VCFs in {:.1f} min".format((time.time() - start) / 60))
+
+	#runs on a prefiltered VCF are timed and estimated by its size
+	for vcf_file, prefiltered_head in prefiltered_heads.items():
+		if prefiltered_head is not None:
+			run_vcf_files[vcf_file] = prefiltered_vcf_files[vcf_file]
+	for (dir_name, vcf_file), features in job_features.items():
+		if prefiltered_heads.get(vcf_file) is not None:
+			job_features[(dir_name, vcf_file)] = get_job_features(prefiltered_heads[vcf_file].get("ContentLength", 0), features["hpo_terms"])
+			estimated_seconds[(dir_name, vcf_file)] = predict_seconds(runtime_model, job_features[(dir_name, vcf_file)])
+
+
+#jobs run at once: limited by the cluster's CPUs or memory, whichever runs out first
+cluster_resources = ray.available_resources()
+parallel_jobs = max(1, min(cluster_resources["CPU"] // job_resources["num_cpus"], cluster_resources.get("memory", float("inf")) // job_resources["memory"]))
+#longest runs first
+unique_jobs = sorted(unique_jobs, key=lambda job: (estimated_seconds[(job[0], job[2])], job_features[(job[0], job[2])]["vcf_mb"], job_features[(job[0], job[2])]["hpo_terms"]), reverse=True)
+sweep_estimates = [estimated_seconds[(job[0], job[2])] for job in unique_jobs]
+print("Estimated runtime: {:.1f} hours ({} jobs at once, {:.1f} GB each)".format(estimate_hours(sweep_estimates, parallel_jobs), int(parallel_jobs), job_resources["memory"] / 2**30))
+if exomiser_target_hours:
+	print("{} job slots needed to finish in {} hours".format(get_slots_needed(sweep_estimates, exomiser_target_hours), exomiser_target_hours))
+progress = SweepProgress(sweep_estimates, parallel_jobs if exomiser_workers == 0 else min(parallel_jobs, exomiser_workers))
+record_runs(exomiser_manifest, [run_folder for job in unique_jobs for run_folder in get_run_folders(job[0], job[2], job[3])], "submitted")
+if exomiser_workers > 0:
+	create_queue(exomiser_queue_dir)
+	enqueue_jobs(exomiser_queue_dir, [("{:08d}".format(i), {"job_id": job_prefix + dir_name, "vcf_file": vcf_file, "run_vcf_file": run_vcf_files[vcf_file], "hpo_file": hpo_file, "hpo_input": input_keys[hpo_file], "base_yml_file": base_yml_file, "base_yml_input": input_keys[base_yml_file], "dir_name": dir_name, "copy_dir_names": copy_dir_names}) for i, (dir_name, hpo_file, vcf_file, copy_dir_names) in enumerate(unique_jobs)])
+	close_queue(exomiser_queue_dir)
+	input_files = sorted(set(job[1] for job in unique_jobs)) + [base_yml_file]
+	worker_ids = {exomiser_worker.remote("worker{}".format(i), input_files, *[input_refs[input_file] for input_file in input_files]): "worker{}".format(i) for i in range(exomiser_workers)}
+	worker_refs = list(worker_ids)
+
+	#record runs as the workers finish them and fan their results out to the runs that share their term list
+	done_jobs = {}
+	copy_refs = {}
+	while len(worker_refs) > 0 or len(done_jobs) < len(get_done_jobs(exomiser_queue_dir)):
+		if len(worker_refs) > 0:
+			stopped_refs, worker_refs = ray.wait(worker_refs, num_returns=len(worker_refs), timeout=10)
+			#jobs a stopped worker still has claimed (its container failed every restart, or its task died) are failed, so the queue drains
+			for ref in stopped_refs:
+				for job_name in fail_jobs(exomiser_queue_dir, worker_ids[ref], error="worker stopped"):
+					print("Job {} failed: worker {} stopped".format(job_name, worker_ids[ref]))
+		for job_name, spec in get_done_jobs(exomiser_queue_dir).items():
+			if job_name in done_jobs:
+				continue
+			done_jobs[job_name] = spec
+			run_folders = get_run_folders(spec["dir_name"], spec["vcf_file"], spec["copy_dir_names"])
+			record_runs(exomiser_manifest, run_folders[:1], "succeeded" if spec["succeeded"] else "failed", seconds=spec.get("seconds"), **job_features[(spec["dir_name"], spec["vcf_file"])])
+			progress.update(estimated_seconds[(spec["dir_name"], spec["vcf_file"])], spec["succeeded"], spec.get("seconds"))
+			if spec["succeeded"] and len(run_folders) > 1:
+				copy_refs[copy_results_task.remote(spec["job_id"], [job_id for job_id, sample_id, fingerprint in run_folders[1:]], run_folders[0][1])] = run_folders[1:]
+		progress.report()
+	for ref, run_folders in copy_refs.items():
+		try:
+			ray.get(ref)
+			record_runs(exomiser_manifest, run_folders, "succeeded")
+		except ray.exceptions.RayError as e:
+			print("Could not copy results to {}: {}".format(", ".join(job_id for job_id, sample_id, fingerprint in run_folders), e))
+			record_runs(exomiser_manifest, run_folders, "failed")
+	progress.report(force=True)
+	failed_jobs = [spec["job_id"] + "/" + os.path.basename(spec["vcf_file"]) for spec in done_jobs.values() if not spec["succeeded"]]
+	print("{} of {} exomiser runs failed {}".format(len(failed_jobs) + len(unique_jobs) - len(done_jobs), len(unique_jobs), " ".join(failed_jobs)))
+else:
+	#submit runs in order, keeping at most max_in_flight unfinished, and record them as they finish
+	max_in_flight = exomiser_max_in_flight or int(2 * parallel_jobs)
+	next_job = 0
+	par_jobs = {}
 
+	#with the VCF cache, every run of a VCF is sent to one node chosen before any of them is submitted (runs of a VCF are submitted
+	#together, so waiting for a first run to finish would spread them over the nodes); VCFs are given, most estimated work first,
+	#to the node with the least work per job slot
+	vcf_nodes = {}
+	if exomiser_vcf_cache_gb > 0:
+		node_slots = {node["NodeID"]: min(node["Resources"].get("CPU", 0) // job_resources["num_cpus"], node["Resources"].get("memory", float("inf")) // job_resources["memory"]) for node in ray.nodes() if node["Alive"]}
+		node_seconds = {node_id: 0 for node_id, slots in node_slots.items() if slots > 0}
+		vcf_seconds = {}
+		for dir_name, hpo_file, vcf_file, copy_dir_names in unique_jobs:
+			vcf_seconds[vcf_file] = vcf_seconds.get(vcf_file, 0) + estimated_seconds[(dir_name, vcf_file)]
+		for vcf_file in sorted(vcf_seconds, key=lambda vcf_file: vcf_seconds[vcf_file], reverse=True):
+			if len(node_seconds) == 0:
+				break
+			vcf_nodes[vcf_file] = min(node_seconds, key=lambda node_id: (node_seconds[node_id] + vcf_seconds[vcf_file]) / node_slots[node_id])
+			node_seconds[vcf_nodes[vcf_file]] += vcf_seconds[vcf_file]
 
-print("Estimated runtime: {} hours".format(round((len(jobs)/ray.available_resources()['CPU']) * 7 / 60)))
-par_jobs = [f.remote(dir_name, hpo_file, vcf_file) for dir_name, hpo_file, vcf_file in jobs]
-x = ray.get(par_jobs)
+	while len(par_jobs) > 0 or next_job < len(unique_jobs):
+		while len(par_jobs) < max_in_flight and next_job < len(unique_jobs):
+			dir_name, hpo_file, vcf_file, copy_dir_names = unique_jobs[next_job]
+			#soft affinity that spills to other nodes while the VCF's node is full, so nodes are not left idle
+			task_options = {}
+			if vcf_file in vcf_nodes:
+				task_options["scheduling_strategy"] = NodeAffinitySchedulingStrategy(vcf_nodes[vcf_file], soft=True, _spill_on_unavailable=True)
+			par_jobs[f.options(**task_options).remote(dir_name, hpo_file, run_vcf_files[vcf_file], input_refs[hpo_file], input_refs[base_yml_file], copy_dir_names)] = (dir_name, vcf_file, copy_dir_names)
+			next_job += 1
+		done_refs, x = ray.wait(list(par_jobs), num_returns=1, timeout=progress.interval)
+		for ref in done_refs:
+			dir_name, vcf_file, copy_dir_names = par_jobs.pop(ref)
+			#a task that raised or died (RayTaskError, or its worker or node lost) fails its runs without stopping the sweep
+			try:
+				job_code, seconds = ray.get(ref)
+			except ray.exceptions.RayError as e:
+				print("Exomiser task of {} on {} failed: {}".format(dir_name, vcf_file, e))
+				job_code, seconds = None, None
+			run_folders = get_run_folders(dir_name, vcf_file, copy_dir_names)
+			state = "succeeded" if job_code == 0 else "failed"
+			record_runs(exomiser_manifest, run_folders[:1], state, seconds=round(seconds, 1) if seconds is not None else None, **job_features[(dir_name, vcf_file)])
+			if len(run_folders) > 1:
+				record_runs(exomiser_manifest, run_folders[1:], state)
+			progress.update(estimated_seconds[(dir_name, vcf_file)], job_code == 0, seconds)
+		progress.report()
+	progress.report(force=True)
 
 ray.shutdown()
 
@@ -404,4 +730,4 @@ ray.shutdown()
 #export AWS_ACCESS_KEY_ID=??????
 #export AWS_SECRET_ACCESS_KEY=??????
 #docker volume create exomiser-data
-#docker run --mount source=exomiser-data,target=/usr/share/applications/exomiser-cli-12.1.0/data --rm -it -e exomiser_job_id=test123 -e exomiser_vcf_file=s3://mybucket/Pfeiffer.vcf -e exomiser_hpo_file=s3://mybucket/NLPoutput_Pfeiffer.txt -e exomiser_base_yml_file=s3://mybucket/test-analysis-exome.yml -e exomiser_Xmx=4g -e write_bucket=mybucket -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY jiggyjsq/exomiser:12.1.0__hg19_2003__pheno_2003 python3.8 run_exomiser_job.py
+#docker run --mount source=exomiser-data,target=/usr/share/applications/exomiser-cli-12.1.0/data --rm -it -e exomiser_job_id=test123 -e exomiser_vcf_file=s3://mybucket/Pfeiffer.vcf -e exomiser_hpo_file=s3://mybucket/NLPoutput_Pfeiffer.txt -e exomiser_base_yml_file=s3://mybucket/test-analysis-exome.yml -e exomiser_Xmx=4g -e write_bucket=mybucket -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY exomiser-pipeline:12.1.0__hg19_2003__pheno_2003 python3.8 run_exomiser_job.py
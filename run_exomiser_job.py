@@ -6,7 +6,21 @@
 ## It assumes some default environment variables: exomiser_Xmx for java max memory and write_bucket where results get upload (appropriate permissions are needed)
 ## It assumes docker image gets AWS credentials from environment variables or Assume Role
 ## 
-## docker run --rm -it -e exomiser_job_id=test -e exomiser_vcf_file=s3://mybucket/Pfeiffer.vcf -e exomiser_hpo_file=s3://mybucket/NLPoutput_Pfeiffer.txt -e exomiser_base_yml_file=s3://mybucket/test-analysis-exome.yml -e exomiser_Xmx=4g -e write_bucket=mybucket -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY jiggyjsq/exomiser:12.1.0__hg19_2003__pheno_2003 python3.8 run_exomiser_job.py
+## docker run --rm -it -e exomiser_job_id=test -e exomiser_vcf_file=s3://mybucket/Pfeiffer.vcf -e exomiser_hpo_file=s3://mybucket/NLPoutput_Pfeiffer.txt -e exomiser_base_yml_file=s3://mybucket/test-analysis-exome.yml -e exomiser_Xmx=4g -e write_bucket=mybucket -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY exomiser-pipeline:12.1.0__hg19_2003__pheno_2003 python3.8 run_exomiser_job.py
+##
+## In worker mode (exomiser_job_queue set to a job_queue.py queue directory mounted into the container) the script stays resident and
+## runs the queued jobs back to back, so container startup and imports are paid once per worker, the base yml and HPO files are
+## downloaded and parsed once, and with exomiser_batch_size > 1 several jobs share one exomiser JVM (--analysis-batch):
+## docker run --rm --mount type=bind,source=/home/ubuntu/exomiser_job_queue,target=/usr/share/queue -e exomiser_job_queue=/usr/share/queue -e exomiser_worker_id=worker0 -e exomiser_Xmx=4g -e write_bucket=mybucket -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY exomiser-pipeline:12.1.0__hg19_2003__pheno_2003 python3.8 run_exomiser_job.py
+##
+## In prefilter mode (exomiser_prefilter_vcf_file set to an S3 path) the script runs only the variant filters of the base yml on the VCF,
+## once, and uploads the VCF lines of the variants that passed them to that path; runs of the VCF's HPO term lists on the prefiltered VCF
+## repeat only the HPO-dependent steps on a few hundred variants instead of annotating and filtering the whole VCF each time:
+## docker run --rm -e exomiser_prefilter_vcf_file=s3://mybucket/exomiser_prefiltered/Pfeiffer.vcf -e exomiser_vcf_file=s3://mybucket/Pfeiffer.vcf -e exomiser_base_yml_file=s3://mybucket/test-analysis-exome.yml -e exomiser_Xmx=4g -e AWS_ACCESS_KEY_ID -e AWS_SECRET_ACCESS_KEY exomiser-pipeline:12.1.0__hg19_2003__pheno_2003 python3.8 run_exomiser_job.py
+##
+## ray_parallel_nlp.py places the base yml and HPO files in a directory on each node, keyed by their content hash, and mounts it into the
+## containers (exomiser_input_dir, with exomiser_base_yml_input and exomiser_hpo_input, or the job spec's base_yml_input and hpo_input, giving
+## the keys); these inputs are copied from there instead of downloaded from S3 when they are present
 ## 
 ## This script was written to support the following paper
 ## "Parikh JR, Genetti CA et al.  A data-driven architecture using natural language processing to improve phenotyping efficiency and accelerate genetic diagnoses of rare disorders."
@@ -19,138 +33,377 @@
 
 import sys
 import uuid
-import boto3
 import os
 import glob
+import time
+import collections
 import pandas as pd
 import yaml
 import shutil
 import json
 import botocore
 import re
-
-print("Downloading Files and Setting up Run...")
+import gzip
+import bisect
+from s3_transfer import get_s3_resource, file_md5
+from file_cache import get_cache_key, cache_fetch, cache_store, evict_cache
+from clinithink_format import iter_patients, read_patient_blocks, split_patients
+from job_queue import claim_jobs, complete_job, release_jobs, is_drained
+from job_resources import is_killed, oom_exit_status
 
 #updatable environment variables
 job_id = os.environ.get("exomiser_job_id")
 vcf_file = os.environ.get("exomiser_vcf_file")
 hpo_file = os.environ.get("exomiser_hpo_file")
 base_yml_file = os.environ.get("exomiser_base_yml_file")
+hpo_input = os.environ.get("exomiser_hpo_input") #keys of the HPO file and base yml in the input directory
+base_yml_input = os.environ.get("exomiser_base_yml_input")
+
+#worker mode environment variables (jobs are taken from the queue instead of the variables above)
+job_queue_dir = os.environ.get("exomiser_job_queue")
+worker_id = os.environ.get("exomiser_worker_id", uuid.uuid4().hex) #a restarted worker with the same ID puts back the jobs it had claimed
+batch_size = int(os.environ.get("exomiser_batch_size", 1)) #number of jobs run by one exomiser process
+max_attempts = int(os.environ.get("exomiser_max_attempts", 30)) #number of times a failing job is run
+cached_files = int(os.environ.get("exomiser_cached_files", 8)) #number of downloaded HPO files (and their parsed term lists) kept by the worker
+poll_interval = 1 #seconds between queue checks while other workers' jobs may still be put back
+
+#node-local VCF cache (a docker volume shared by the containers of a node); unset to download the VCF for every job
+vcf_cache_dir = os.environ.get("exomiser_vcf_cache_dir")
+vcf_cache_max_bytes = float(os.environ.get("exomiser_vcf_cache_gb", 50)) * 2**30
+
+#directory of inputs shared by the jobs (file_cache.py layout, keyed by content hash) placed on the node by ray_parallel_nlp.py; unset to download every input
+input_dir = os.environ.get("exomiser_input_dir")
 
-sample_id = os.path.splitext(os.path.basename(vcf_file))[0]
+#prefilter mode: S3 path the VCF lines of the variants passing the base yml's variant filters are written to
+prefilter_vcf_file = os.environ.get("exomiser_prefilter_vcf_file")
+
+#analysis steps that only depend on the variants; the HPO-dependent steps (prioritisers and priorityScoreFilter) and the inheritanceFilter,
+#which only removes variants that passed the other filters, are left to the runs on the prefiltered VCF
+variant_filter_steps = ["failedVariantFilter", "intervalFilter", "genePanelFilter", "qualityFilter", "variantEffectFilter", "regulatoryFeatureFilter", "knownVariantFilter", "frequencyFilter", "pathogenicityFilter"]
+
+#output options that would leave passing variants out of a prefilter run's variants.tsv, and the values that keep every one of them (None removes the option)
+unlimited_output_options = {"outputContributingVariantsOnly": False, "numGenes": 0, "minExomiserGeneScore": None}
 
 #default environment variable
 write_bucket = os.environ.get("write_bucket")
 Xmx = os.environ.get("exomiser_Xmx")
 
-s3 = boto3.resource("s3")
+s3 = get_s3_resource()
+
+data_root = os.environ.get("exomiser_data_root", "/usr/share/data")
+results_root = os.environ.get("exomiser_results_root", "/usr/share/results")
+
+
+def split_s3_path(s3_path):
+	bucket = re.match("s3://(.+?)/.+", s3_path).groups()[0]
+	return(bucket, s3_path.replace("s3://" + bucket + "/", ""))
+
+
+def download(s3_path, local_path):
+	bucket, key = split_s3_path(s3_path)
+	s3.Bucket(bucket).download_file(key, local_path)
+
+
+#copy a shared input from the input directory, or download it if it is not there (no key given, or evicted)
+def get_input(s3_path, input_key, local_path):
+	if input_dir is not None and input_key is not None and cache_fetch(input_dir, input_key, local_path):
+		return
+	download(s3_path, local_path)
+
+
+#content md5 of an object from its head_object response, None if unknown: the md5 metadata set by s3_transfer.upload_changed_files,
+#else the ETag, which is only the md5 for objects uploaded in one part and not encrypted with SSE-KMS or SSE-C
+def get_object_md5(head):
+	if "md5" in head.get("Metadata", {}):
+		return(head["Metadata"]["md5"])
+	if "-" in head["ETag"] or head.get("ServerSideEncryption", "").startswith("aws:kms") or "SSECustomerAlgorithm" in head:
+		return(None)
+	return(head["ETag"].strip('"'))
+
+
+#download a VCF through the node's VCF cache; entries are keyed on the object's ETag, so a changed VCF is downloaded again, and
+#downloads are checked against the object's size and (where known, see get_object_md5) content md5 before they are cached
+vcfs_seen = set() #VCFs this process has fetched, which a worker prefers when taking jobs from the queue
+def download_vcf(vcf_file, local_path):
+	vcfs_seen.add(vcf_file)
+	if vcf_cache_dir is None:
+		download(vcf_file, local_path)
+		return
+	bucket, key = split_s3_path(vcf_file)
+	head = s3.meta.client.head_object(Bucket=bucket, Key=key)
+	cache_key = get_cache_key("vcf", vcf_file, head["ETag"])
+	if cache_fetch(vcf_cache_dir, cache_key, local_path):
+		return
+	download(vcf_file, local_path)
+	if os.path.getsize(local_path) != head["ContentLength"]:
+		raise ValueError("Downloaded {} has {} bytes, expected {}".format(vcf_file, os.path.getsize(local_path), head["ContentLength"]))
+	md5 = get_object_md5(head)
+	if md5 is not None and file_md5(local_path) != md5:
+		raise ValueError("Downloaded {} does not match its md5 {}".format(vcf_file, md5))
+	cache_store(vcf_cache_dir, cache_key, local_path)
+	evict_cache(vcf_cache_dir, vcf_cache_max_bytes)
+
+
+#files downloaded by a worker and kept for later jobs ({s3 path: local path}, least recently used first), and the term lists parsed from them
+file_cache = collections.OrderedDict()
+term_list_cache = {}
+
+
+def get_cached_file(s3_path, input_key=None):
+	if s3_path not in file_cache:
+		local_path = os.path.join(data_root, "cached_{}_{}".format(uuid.uuid4().hex, os.path.basename(s3_path)))
+		get_input(s3_path, input_key, local_path)
+		file_cache[s3_path] = local_path
+		if len(file_cache) > cached_files:
+			evicted_path, evicted_local_path = file_cache.popitem(last=False)
+			os.remove(evicted_local_path)
+			term_list_cache.pop(evicted_path, None)
+	file_cache.move_to_end(s3_path)
+	return(file_cache[s3_path])
+
 
 #create folders for run - uuid.uuid4().hex
-run_uuid = uuid.uuid4().hex
-data_dir = os.path.join("/usr/share/data", run_uuid)
-results_dir = os.path.join("/usr/share/results", run_uuid)
-if not os.path.exists(data_dir):
-	os.mkdir(data_dir)
-if not os.path.exists(results_dir):
-	os.mkdir(results_dir)
-
-
-#copy base yml, vcf and nl_hpo files to job data dir from s3
-s3.Bucket(re.match("s3://(.+?)/.+", vcf_file).groups()[0]).download_file(vcf_file.replace("s3://" + re.match("s3://(.+?)/.+", vcf_file).groups()[0] + "/", "") , os.path.join(data_dir, os.path.basename(vcf_file)))
-s3.Bucket(re.match("s3://(.+?)/.+", hpo_file).groups()[0]).download_file(hpo_file.replace("s3://" + re.match("s3://(.+?)/.+", hpo_file).groups()[0] + "/", "") , os.path.join(data_dir, os.path.basename(hpo_file)))
-s3.Bucket(re.match("s3://(.+?)/.+", base_yml_file).groups()[0]).download_file(base_yml_file.replace("s3://" + re.match("s3://(.+?)/.+", base_yml_file).groups()[0] + "/", "") , os.path.join(data_dir, os.path.basename(base_yml_file)))
-
-#parse HPO file to get HPO terms of the patient
-fh = open(os.path.join(data_dir, os.path.basename(hpo_file)))
-hpo_terms = []
-sample_id_found = False
-for line in fh:
-	line = line.strip().split(",")
-	if len(line) == 1:
-		if sample_id_found:
-			break
-		key = line[0]
-		if key == sample_id:
-			sample_id_found = True
-	elif line[0] == "Criterion":
-		pass
+def create_run_dirs():
+	run_uuid = uuid.uuid4().hex
+	data_dir = os.path.join(data_root, run_uuid)
+	results_dir = os.path.join(results_root, run_uuid)
+	if not os.path.exists(data_dir):
+		os.mkdir(data_dir)
+	if not os.path.exists(results_dir):
+		os.mkdir(results_dir)
+	return(data_dir, results_dir)
+
+
+#download a job's inputs to its run folders and write its analysis yml; returns the job's run folders and files
+def prepare_job(job_id, vcf_file, hpo_file, base_yml_file, data_dir, results_dir, hpo_input=None, base_yml_input=None):
+	sample_id = os.path.splitext(os.path.basename(vcf_file))[0]
+
+	#copy base yml, vcf and nl_hpo files to job data dir from s3 (a worker reuses the base yml and HPO files it already has)
+	download_vcf(vcf_file, os.path.join(data_dir, os.path.basename(vcf_file)))
+	if job_queue_dir is None:
+		get_input(hpo_file, hpo_input, os.path.join(data_dir, os.path.basename(hpo_file)))
+		get_input(base_yml_file, base_yml_input, os.path.join(data_dir, os.path.basename(base_yml_file)))
+		base_yml_path = os.path.join(data_dir, os.path.basename(base_yml_file))
+
+		#parse HPO file to get HPO terms of the patient (the file is streamed a chunk of patients at a time and read up to the patient)
+		hpo_terms = []
+		for patient, patient_terms in iter_patients(os.path.join(data_dir, os.path.basename(hpo_file))):
+			if patient == sample_id:
+				hpo_terms = list(patient_terms.Criterion)
+				break
 	else:
-		if sample_id_found:
-			hpo_terms.append(line[0])
-fh.close()
-
-if (sample_id_found == False) or (len(hpo_terms) == 0):
-	raise
-
-hpo_terms = list(map(lambda x: x.split("_")[0].replace("hp", "HP:"), hpo_terms))
-
-#edit yaml file
-#replace vcf file path, hpo terms, and results file prefix
-
-fname = os.path.join(data_dir, os.path.basename(base_yml_file))
-with open(fname, "r") as fh:
-	data = yaml.safe_load(fh)
-
-data["analysis"]["vcf"] = os.path.join(data_dir, os.path.basename(vcf_file))
-data["analysis"]["hpoIds"] = hpo_terms
-data["outputOptions"]["outputPrefix"] = os.path.join(results_dir, sample_id)
-
-
-with open(fname, "w") as yaml_file:
-    yaml_file.write(yaml.dump(data, default_flow_style=True, sort_keys=False))
-    
-
-#run exomiser
-print("Running Exomiser...")
-os.system("java -jar -Xmx"+Xmx + " exomiser-cli-12.1.0/exomiser-cli-12.1.0.jar --analysis " + os.path.join(data_dir, os.path.basename(base_yml_file)) + " --spring.config.location=exomiser-cli-12.1.0/application.properties")
-
-#create result tab file from json output
-print("Collect and Upload Results to S3...")
-html_result_file = os.path.join(results_dir, sample_id+".html")
-json_result_file = os.path.join(results_dir, sample_id+".json")
-tab_result_file = os.path.join(results_dir, sample_id+".tab")
-
-result_genes = []
-with open(json_result_file) as fh:
-	result_json = json.load(fh)
-	for gene in result_json:
-		result_genes.append([gene["geneSymbol"], gene["combinedScore"], gene["variantScore"], gene["priorityScore"]])
-	
-result_genes_df = pd.DataFrame(data=result_genes, columns=["Gene", "Combined_Score", "Genetic_Score", "Phenotype_score"])
-result_genes_df.to_csv(tab_result_file, sep="\t", index=False)
-
-
-#upload results to S3
-#create folder in S3 corresponding to jobID if it doesn't exist
-#create sub folders in S3 for html, json, and tab if run_category parent folder don't exist
-try:
-	s3.Object(write_bucket, "exomiser_results/" + job_id + "/").load()
-except botocore.exceptions.ClientError as e:
-	if e.response["Error"]["Code"] == "404":
-		s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/"))
-		s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/html/"))
-		s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/json/"))
-		s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/tab/"))		
-	else:
-		raise
-else:
-	pass
+		base_yml_path = get_cached_file(base_yml_file, base_yml_input)
 
+		#parse the whole HPO file once per worker
+		hpo_path = get_cached_file(hpo_file, hpo_input)
+		if hpo_file not in term_list_cache:
+			term_list_cache[hpo_file] = {patient: list(patient_terms.Criterion) for patient, patient_terms in split_patients(read_patient_blocks(hpo_path))}
+		hpo_terms = term_list_cache[hpo_file].get(sample_id, [])
 
+	if len(hpo_terms) == 0:
+		raise ValueError("No HPO terms found for {} in {}".format(sample_id, hpo_file))
 
-#upload results to respective folders on S3
-s3.Bucket(write_bucket).upload_file(html_result_file, "exomiser_results/" + job_id + "/html/" + os.path.basename(html_result_file))
-s3.Bucket(write_bucket).upload_file(json_result_file, "exomiser_results/" + job_id + "/json/" + os.path.basename(json_result_file))
-s3.Bucket(write_bucket).upload_file(tab_result_file, "exomiser_results/" + job_id + "/tab/" + os.path.basename(tab_result_file))
+	hpo_terms = list(map(lambda x: x.split("_")[0].replace("hp", "HP:"), hpo_terms))
 
-#delete run folder (in case re-using a fully loaded container makes more sense)
-shutil.rmtree(data_dir) 
-shutil.rmtree(results_dir) 
+	#edit yaml file
+	#replace vcf file path, hpo terms, and results file prefix
+	with open(base_yml_path, "r") as fh:
+		data = yaml.safe_load(fh)
 
+	data["analysis"]["vcf"] = os.path.join(data_dir, os.path.basename(vcf_file))
+	data["analysis"]["hpoIds"] = hpo_terms
+	data["outputOptions"]["outputPrefix"] = os.path.join(results_dir, sample_id)
 
+	fname = os.path.join(data_dir, os.path.basename(base_yml_file))
+	with open(fname, "w") as yaml_file:
+	    yaml_file.write(yaml.dump(data, default_flow_style=True, sort_keys=False))
 
+	return({"job_id": job_id, "sample_id": sample_id, "data_dir": data_dir, "results_dir": results_dir, "analysis_file": fname})
 
 
+#run exomiser on one analysis yml, or on several in one JVM with --analysis-batch (a file listing the yml files)
+#a JVM killed by the container's OOM killer exits the script with oom_exit_status, so the container is restarted once memory is free
+#(a worker puts back the jobs it had claimed when it restarts)
+def run_exomiser(analysis_files):
+	if len(analysis_files) == 1:
+		status = os.system("java -jar -Xmx"+Xmx + " exomiser-cli-12.1.0/exomiser-cli-12.1.0.jar --analysis " + analysis_files[0] + " --spring.config.location=exomiser-cli-12.1.0/application.properties")
+	else:
+		batch_file = os.path.join(data_root, "batch_{}.txt".format(uuid.uuid4().hex))
+		with open(batch_file, "w") as fhw:
+			fhw.write("\n".join(analysis_files) + "\n")
+		status = os.system("java -jar -Xmx"+Xmx + " exomiser-cli-12.1.0/exomiser-cli-12.1.0.jar --analysis-batch " + batch_file + " --spring.config.location=exomiser-cli-12.1.0/application.properties")
+		os.remove(batch_file)
+	if is_killed(status):
+		print("Exomiser was killed, most likely for running out of memory")
+		sys.exit(oom_exit_status)
+
+
+#analysis (parsed yml) running only the variant filters of a base analysis, with every variant that passes them written to <output_prefix>.variants.tsv
+#(the base analysis' output limits are lifted, so the variants of every gene are kept, not only those the full analysis would report)
+def get_prefilter_analysis(data, vcf_path, output_prefix):
+	data["analysis"]["vcf"] = vcf_path
+	data["analysis"]["hpoIds"] = []
+	data["analysis"]["steps"] = [step for step in data["analysis"].get("steps", []) if list(step)[0] in variant_filter_steps]
+	for option, value in unlimited_output_options.items():
+		if value is None:
+			data["outputOptions"].pop(option, None)
+		else:
+			data["outputOptions"][option] = value
+	data["outputOptions"]["outputPrefix"] = output_prefix
+	data["outputOptions"]["outputFormats"] = ["TSV_VARIANT"]
+	return(data)
+
+
+#run the variant filters of the base yml on a VCF and upload the lines of the VCF with a variant that passed them to prefilter_vcf_file
+#(PASS_ONLY analyses only: a FULL analysis reports the failed variants too, which the prefiltered VCF no longer has)
+def prefilter_vcf(vcf_file, base_yml_file, prefilter_vcf_file, base_yml_input=None):
+	data_dir, results_dir = create_run_dirs()
+	sample_id = os.path.splitext(os.path.basename(vcf_file))[0]
+	vcf_path = os.path.join(data_dir, os.path.basename(vcf_file))
+	download_vcf(vcf_file, vcf_path)
+	get_input(base_yml_file, base_yml_input, os.path.join(data_dir, os.path.basename(base_yml_file)))
+
+	with open(os.path.join(data_dir, os.path.basename(base_yml_file)), "r") as fh:
+		data = yaml.safe_load(fh)
+	if data["analysis"].get("analysisMode", "PASS_ONLY") != "PASS_ONLY":
+		raise ValueError("VCFs can only be prefiltered for PASS_ONLY analyses, {} has analysisMode {}".format(base_yml_file, data["analysis"]["analysisMode"]))
+
+	data = get_prefilter_analysis(data, vcf_path, os.path.join(results_dir, sample_id))
+	fname = os.path.join(data_dir, "prefilter_" + os.path.basename(base_yml_file))
+	with open(fname, "w") as yaml_file:
+	    yaml_file.write(yaml.dump(data, default_flow_style=True, sort_keys=False))
+	run_exomiser([fname])
+
+	#sorted positions of the passing variants on each chromosome
+	variants = pd.read_csv(os.path.join(results_dir, sample_id + ".variants.tsv"), sep="\t", usecols=["#CHROM", "POS", "FILTER"], dtype={"#CHROM": str})
+	variants = variants[variants.FILTER == "PASS"]
+	passed_positions = {chrom: sorted(chrom_variants.POS) for chrom, chrom_variants in variants.groupby(variants["#CHROM"].str.replace("^chr", "", regex=True))}
+
+	#keep the header and every line overlapping a passing variant (exomiser reports trimmed alleles, which can start after the VCF's POS)
+	open_vcf = gzip.open if vcf_path.endswith(".gz") else open
+	prefiltered_path = os.path.join(results_dir, os.path.basename(vcf_file))
+	kept = 0
+	with open_vcf(vcf_path, "rt") as fh, open_vcf(prefiltered_path, "wt") as fhw:
+		for line in fh:
+			if not line.startswith("#"):
+				fields = line.split("\t", 5)
+				positions = passed_positions.get(re.sub("^chr", "", fields[0]), [])
+				pos = int(fields[1])
+				i = bisect.bisect_left(positions, pos)
+				if i == len(positions) or positions[i] > pos + len(fields[3]):
+					continue
+				kept += 1
+			fhw.write(line)
+
+	bucket, key = split_s3_path(prefilter_vcf_file)
+	s3.Bucket(bucket).upload_file(prefiltered_path, key)
+	print("Kept {} variant lines of {} in {}".format(kept, vcf_file, prefilter_vcf_file))
+
+	shutil.rmtree(data_dir)
+	shutil.rmtree(results_dir)
+
+
+#create the result tab file from the json output and upload the html/json/tab results to S3
+def upload_results(job):
+	job_id, sample_id, data_dir, results_dir = job["job_id"], job["sample_id"], job["data_dir"], job["results_dir"]
+	html_result_file = os.path.join(results_dir, sample_id+".html")
+	json_result_file = os.path.join(results_dir, sample_id+".json")
+	tab_result_file = os.path.join(results_dir, sample_id+".tab")
+
+	result_genes = []
+	with open(json_result_file) as fh:
+		result_json = json.load(fh)
+		for gene in result_json:
+			result_genes.append([gene["geneSymbol"], gene["combinedScore"], gene["variantScore"], gene["priorityScore"]])
+		
+	result_genes_df = pd.DataFrame(data=result_genes, columns=["Gene", "Combined_Score", "Genetic_Score", "Phenotype_score"])
+	result_genes_df.to_csv(tab_result_file, sep="\t", index=False)
+
+
+	#upload results to S3
+	#create folder in S3 corresponding to jobID if it doesn't exist
+	#create sub folders in S3 for html, json, and tab if run_category parent folder don't exist
+	try:
+		s3.Object(write_bucket, "exomiser_results/" + job_id + "/").load()
+	except botocore.exceptions.ClientError as e:
+		if e.response["Error"]["Code"] == "404":
+			s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/"))
+			s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/html/"))
+			s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/json/"))
+			s3.meta.client.put_object(Bucket=write_bucket, Key=("exomiser_results/" + job_id + "/tab/"))		
+		else:
+			raise
+	else:
+		pass
 
 
 
+	#upload results to respective folders on S3
+	s3.Bucket(write_bucket).upload_file(html_result_file, "exomiser_results/" + job_id + "/html/" + os.path.basename(html_result_file))
+	s3.Bucket(write_bucket).upload_file(json_result_file, "exomiser_results/" + job_id + "/json/" + os.path.basename(json_result_file))
+	s3.Bucket(write_bucket).upload_file(tab_result_file, "exomiser_results/" + job_id + "/tab/" + os.path.basename(tab_result_file))
+
+	#delete run folder
+	shutil.rmtree(data_dir) 
+	shutil.rmtree(results_dir) 
+
+
+#take batches of jobs from the queue until it is drained; failed jobs are put back until they have been tried max_attempts times
+def run_worker():
+	release_jobs(job_queue_dir, worker_id)
+	while True:
+		jobs = claim_jobs(job_queue_dir, worker_id, batch_size, prefer=lambda spec: spec.get("run_vcf_file", spec["vcf_file"]) in vcfs_seen)
+		if len(jobs) == 0:
+			if is_drained(job_queue_dir):
+				break
+			time.sleep(poll_interval)
+			continue
+
+		start = time.time()
+		run_dirs = {job_name: create_run_dirs() for job_name, spec in jobs}
+		prepared_jobs = {}
+		for job_name, spec in jobs:
+			try:
+				#run_vcf_file is the job's prefiltered VCF in a two-phase sweep
+				prepared_jobs[job_name] = prepare_job(spec["job_id"], spec.get("run_vcf_file", spec["vcf_file"]), spec["hpo_file"], spec["base_yml_file"], *run_dirs[job_name], spec.get("hpo_input"), spec.get("base_yml_input"))
+			except Exception as e:
+				print("Job {} failed: {}".format(job_name, e))
+		if len(prepared_jobs) > 0:
+			run_exomiser([job["analysis_file"] for job in prepared_jobs.values()])
+
+		for job_name, spec in jobs:
+			succeeded = False
+			if job_name in prepared_jobs:
+				try:
+					upload_results(prepared_jobs[job_name])
+					succeeded = True
+				except Exception as e:
+					print("Job {} failed: {}".format(job_name, e))
+			if not succeeded:
+				for run_dir in run_dirs[job_name]:
+					shutil.rmtree(run_dir, ignore_errors=True)
+			#jobs of a batch share its run time
+			complete_job(job_queue_dir, worker_id, job_name, spec, succeeded, max_attempts, seconds=round((time.time() - start) / len(jobs), 1))
+		print("Ran {} jobs in {:.1f}s".format(len(jobs), time.time() - start))
+
+	for local_path in file_cache.values():
+		os.remove(local_path)
+
+
+if __name__ == "__main__":
+	if prefilter_vcf_file is not None:
+		print("Prefiltering {}...".format(vcf_file))
+		prefilter_vcf(vcf_file, base_yml_file, prefilter_vcf_file, base_yml_input)
+	elif job_queue_dir is None:
+		print("Downloading Files and Setting up Run...")
+		job = prepare_job(job_id, vcf_file, hpo_file, base_yml_file, *create_run_dirs(), hpo_input, base_yml_input)
+
+		#run exomiser
+		print("Running Exomiser...")
+		run_exomiser([job["analysis_file"]])
+
+		print("Collect and Upload Results to S3...")
+		upload_results(job)
+	else:
+		print("Running Exomiser jobs from {} as worker {}...".format(job_queue_dir, worker_id))
+		run_worker()
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+##################################################
+## This module keeps the run manifest of ray_parallel_nlp.py: a JSON lines file with a record per exomiser result folder
+## (job_id, sample_id, fingerprint of the run's inputs and state: "submitted", "succeeded" or "failed") appended as runs
+## are submitted and finish, so a driver that stops part way can be restarted and skip the runs that are already done.
+## The last record of a run is its current state; a partly written last line (driver killed while writing) is ignored.
+##################################################
+
+import os
+import json
+import hashlib
+from datetime import datetime
+
+
+#hash of the inputs that determine a run's results (any JSON-serializable dict)
+def get_fingerprint(inputs):
+	return(hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest())
+
+
+#every record in a manifest, oldest first ([] if it does not exist)
+def read_manifest_records(manifest_path):
+	records = []
+	if not os.path.exists(manifest_path):
+		return(records)
+	with open(manifest_path) as fh:
+		for line in fh:
+			try:
+				records.append(json.loads(line))
+			except ValueError:
+				continue
+	return(records)
+
+
+#{(job_id, sample_id): latest record} of the runs in a manifest
+def load_manifest(manifest_path):
+	return({(record["job_id"], record["sample_id"]): record for record in read_manifest_records(manifest_path)})
+
+
+#append the state of runs [(job_id, sample_id, fingerprint)] (with any other fields, e.g. run time) and flush it to disk
+def record_runs(manifest_path, runs, state, **fields):
+	timestamp = datetime.now().isoformat(timespec="seconds")
+	#start on a new line after a partly written last line
+	partial_line = False
+	if os.path.exists(manifest_path) and os.path.getsize(manifest_path) > 0:
+		with open(manifest_path, "rb") as fh:
+			fh.seek(-1, os.SEEK_END)
+			partial_line = fh.read(1) != b"\n"
+	with open(manifest_path, "a") as fhw:
+		if partial_line:
+			fhw.write("\n")
+		for job_id, sample_id, fingerprint in runs:
+			fhw.write(json.dumps({"time": timestamp, "job_id": job_id, "sample_id": sample_id, "fingerprint": fingerprint, "state": state, **fields}) + "\n")
+		fhw.flush()
+		os.fsync(fhw.fileno())
+
+
+#true if the manifest has a run as succeeded with the given input fingerprint
+def is_run_complete(manifest, job_id, sample_id, fingerprint):
+	record = manifest.get((job_id, sample_id))
+	return(record is not None and record["state"] == "succeeded" and record["fingerprint"] == fingerprint)
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+##################################################
+## This module estimates exomiser run times for ray_parallel_nlp.py. A linear model of run time on VCF size (MB) and number
+## of HPO terms is fitted by least squares to the runs timed in earlier sweeps (the "seconds" recorded in the run manifest);
+## until there are min_runs timed runs every job is estimated at default_job_seconds. The estimates give the expected
+## runtime (simulating the order runs are started in) and the number of job slots needed for a target runtime before a sweep starts, and SweepProgress reports
+## throughput, failures and an ETA while it runs, scaling the remaining estimates by how far the finished runs were off.
+##################################################
+
+import math
+import time
+import heapq
+import numpy as np
+
+
+default_job_seconds = 7 * 60
+min_runs = 10
+feature_names = ["vcf_mb", "hpo_terms"]
+
+
+def get_job_features(vcf_bytes, hpo_terms):
+	return({"vcf_mb": round(vcf_bytes / 2**20, 3), "hpo_terms": hpo_terms})
+
+
+#least squares fit of seconds = intercept + coefficients . features on succeeded runs with "seconds" and the feature fields; None if too few
+def fit_runtime_model(records):
+	records = [record for record in records if record.get("state") == "succeeded" and record.get("seconds") is not None and all(name in record for name in feature_names)]
+	if len(records) < min_runs:
+		return(None)
+	X = np.array([[1.0] + [record[name] for name in feature_names] for record in records])
+	y = np.array([record["seconds"] for record in records])
+	coefficients = np.linalg.lstsq(X, y, rcond=None)[0]
+	return({"coefficients": coefficients.tolist(), "runs": len(records), "min_seconds": float(y.min())})
+
+
+#estimated seconds of a run (never less than the shortest timed run)
+def predict_seconds(model, features):
+	if model is None:
+		return(default_job_seconds)
+	seconds = model["coefficients"][0] + sum(coefficient * features[name] for coefficient, name in zip(model["coefficients"][1:], feature_names))
+	return(max(seconds, model["min_seconds"]))
+
+
+#hours to run jobs of estimated_seconds on parallel_jobs slots when they are started in the given order, each on the first free slot
+def estimate_hours(estimated_seconds, parallel_jobs):
+	slots = [0.0] * int(parallel_jobs)
+	for seconds in estimated_seconds:
+		heapq.heappush(slots, heapq.heappop(slots) + seconds)
+	return(max(slots) / 3600)
+
+
+#job slots needed to run jobs of estimated_seconds in target_hours
+def get_slots_needed(estimated_seconds, target_hours):
+	return(math.ceil(sum(estimated_seconds) / (target_hours * 3600)))
+
+
+#counts finished runs and prints throughput, failures and ETA at most every interval seconds
+class SweepProgress:
+
+	def __init__(self, estimated_seconds, parallel_jobs, interval=30):
+		self.remaining_estimate = sum(estimated_seconds)
+		self.total = len(estimated_seconds)
+		self.parallel_jobs = parallel_jobs
+		self.interval = interval
+		self.done = 0
+		self.failed = 0
+		self.estimated_done = 0 #estimates and measured seconds of the timed finished runs
+		self.measured_done = 0
+		self.start = time.time()
+		self.last_report = self.start
+
+	def update(self, estimated_seconds, succeeded, seconds=None):
+		self.done += 1
+		self.failed += 0 if succeeded else 1
+		self.remaining_estimate -= estimated_seconds
+		if succeeded and seconds is not None:
+			self.estimated_done += estimated_seconds
+			self.measured_done += seconds
+
+	def eta_seconds(self):
+		scale = self.measured_done / self.estimated_done if self.estimated_done > 0 else 1
+		return(max(self.remaining_estimate, 0) * scale / self.parallel_jobs)
+
+	def report(self, force=False):
+		now = time.time()
+		if not force and now - self.last_report < self.interval:
+			return
+		self.last_report = now
+		elapsed = max(now - self.start, 1e-9)
+		print("{}/{} exomiser runs done ({} failed) in {:.1f} min, {:.1f} runs/min, ETA {:.1f} min".format(self.done, self.total, self.failed, elapsed / 60, self.done / elapsed * 60, self.eta_seconds() / 60))
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+##################################################
+## This module contains the S3 transfer helpers used by the pipeline scripts: concurrent object fetches with
+## retries for transient errors, and uploads that skip files whose content is already in the bucket. Functions take a boto3 S3 client (s3.meta.client) or any object with the same
+## methods, such as local_object_store.LocalS3Client, so they can be run without AWS. get_s3_resource returns the
+## local stand-in instead of boto3 when the local_s3_root environment variable is set (used by the offline benchmarks).
+##################################################
+
+import os
+import json
+import time
+import hashlib
+import concurrent.futures
+import boto3
+import botocore.exceptions
+from local_object_store import LocalS3Client, LocalS3Resource
+
+
+#boto3 S3 resource, or a local-filesystem stand-in rooted at $local_s3_root (with $local_s3_latency seconds per request)
+def get_s3_resource():
+	if os.environ.get("local_s3_root"):
+		return(LocalS3Resource(LocalS3Client(os.environ["local_s3_root"], latency=float(os.environ.get("local_s3_latency", 0)))))
+	return(boto3.resource("s3"))
+
+
+#S3 error codes worth retrying (throttling, timeouts and server-side errors)
+transient_error_codes = {"RequestTimeout", "SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "InternalError", "ServiceUnavailable", "500", "502", "503", "504"}
+
+
+def is_transient_error(e):
+	if isinstance(e, botocore.exceptions.ClientError):
+		return(e.response.get("Error", {}).get("Code") in transient_error_codes)
+	return(isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError, ConnectionError, TimeoutError)))
+
+
+#call func(), retrying transient errors up to max_retries times with exponential backoff
+def with_retries(func, max_retries=5, backoff=0.5):
+	for attempt in range(max_retries + 1):
+		try:
+			return(func())
+		except Exception as e:
+			if attempt == max_retries or not is_transient_error(e):
+				raise
+			time.sleep(backoff * 2 ** attempt)
+
+
+#read the full body of an object (the read is retried too since the stream can fail part way)
+def get_object_body(client, bucket, key, max_retries=5, backoff=0.5):
+	return(with_retries(lambda: client.get_object(Bucket=bucket, Key=key)["Body"].read(), max_retries, backoff))
+
+
+#fetch objects with a bounded pool of concurrency threads; yields (key, body) in the order of keys
+#and prints the overall throughput once all objects have been read
+def fetch_objects(client, bucket, keys, concurrency=16, max_retries=5, backoff=0.5):
+	keys = list(keys)
+	start = time.time()
+	num_bytes = 0
+	with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+		for key, body in zip(keys, executor.map(lambda key: get_object_body(client, bucket, key, max_retries, backoff), keys)):
+			num_bytes += len(body)
+			yield key, body
+
+	elapsed = max(time.time() - start, 1e-9)
+	print("Fetched {} objects ({:.1f} MB) from s3://{} in {:.1f}s ({:.1f} objects/s, {:.2f} MB/s)".format(len(keys), num_bytes / 1e6, bucket, elapsed, len(keys) / elapsed, num_bytes / 1e6 / elapsed))
+
+
+def file_md5(path):
+	md5 = hashlib.md5()
+	with open(path, "rb") as fh:
+		for chunk in iter(lambda: fh.read(1 << 20), b""):
+			md5.update(chunk)
+	return(md5.hexdigest())
+
+
+#remote ETag/metadata of an object, None if it does not exist
+def head_object(client, bucket, key, max_retries=5, backoff=0.5):
+	try:
+		return(with_retries(lambda: client.head_object(Bucket=bucket, Key=key), max_retries, backoff))
+	except botocore.exceptions.ClientError as e:
+		if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+			return(None)
+		raise
+
+
+#server-side copy of an object within a bucket
+def copy_object(client, bucket, source_key, key, max_retries=5, backoff=0.5):
+	with_retries(lambda: client.copy_object(Bucket=bucket, Key=key, CopySource={"Bucket": bucket, "Key": source_key}), max_retries, backoff)
+
+
+#upload {local_path: key} files, skipping objects whose remote content already matches the local file
+#the local manifest ({key: {"md5", "etag"}}) records the content hash and resulting ETag of every upload, so objects
+#uploaded in multiple parts (whose ETag is not the content md5) are recognised as unchanged too
+def upload_changed_files(client, bucket, files, manifest_path, concurrency=16, max_retries=5, backoff=0.5):
+	manifest = {}
+	if os.path.exists(manifest_path):
+		with open(manifest_path) as fh:
+			manifest = json.load(fh)
+
+	def upload_if_changed(local_path, key):
+		md5 = file_md5(local_path)
+		remote = head_object(client, bucket, key, max_retries, backoff)
+		if remote is not None:
+			etag = remote.get("ETag")
+			if etag == '"{}"'.format(md5) or remote.get("Metadata", {}).get("md5") == md5 or manifest.get(key) == {"md5": md5, "etag": etag}:
+				return(False, {"md5": md5, "etag": etag})
+		with_retries(lambda: client.upload_file(local_path, bucket, key, ExtraArgs={"Metadata": {"md5": md5}}), max_retries, backoff)
+		return(True, {"md5": md5, "etag": head_object(client, bucket, key, max_retries, backoff)["ETag"]})
+
+	start = time.time()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+		results = list(executor.map(lambda item: upload_if_changed(*item), files.items()))
+
+	uploaded = []
+	for (local_path, key), (changed, entry) in zip(files.items(), results):
+		manifest[key] = entry
+		if changed:
+			uploaded.append(key)
+
+	with open(manifest_path, "w") as fhw:
+		json.dump(manifest, fhw, indent=1, sort_keys=True)
+
+	print("Uploaded {} of {} files to s3://{} ({} unchanged) in {:.1f}s".format(len(uploaded), len(files), bucket, len(files) - len(uploaded), time.time() - start))
+	return(uploaded)
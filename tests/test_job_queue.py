@@ -0,0 +1,69 @@
+import threading
+
+from job_queue import create_queue, enqueue_jobs, close_queue, claim_jobs, complete_job, release_jobs, fail_jobs, is_drained, get_done_jobs
+
+
+def make_queue(tmp_path, num_jobs):
+	queue_dir = str(tmp_path / "queue")
+	create_queue(queue_dir)
+	enqueue_jobs(queue_dir, [("{:08d}".format(i), {"job_id": "job{}".format(i)}) for i in range(num_jobs)])
+	close_queue(queue_dir)
+	return(queue_dir)
+
+
+#a worker that claims batch_size jobs at a time until the queue is drained (as run_exomiser_job.run_worker)
+def drain(queue_dir, worker_id, batch_size=1, poll_interval=0.01, timeout=5):
+	stop = threading.Event()
+	def run():
+		while not stop.is_set():
+			jobs = claim_jobs(queue_dir, worker_id, batch_size)
+			if len(jobs) == 0:
+				if is_drained(queue_dir):
+					return
+				stop.wait(poll_interval)
+				continue
+			for job_name, spec in jobs:
+				complete_job(queue_dir, worker_id, job_name, spec, True)
+	thread = threading.Thread(target=run)
+	thread.start()
+	thread.join(timeout)
+	stop.set()
+	return(not thread.is_alive())
+
+
+def test_jobs_are_claimed_once_and_drained(tmp_path):
+	queue_dir = make_queue(tmp_path, 5)
+	assert drain(queue_dir, "worker0", batch_size=2)
+	done_jobs = get_done_jobs(queue_dir)
+	assert sorted(done_jobs) == ["{:08d}".format(i) for i in range(5)]
+	assert all(spec["succeeded"] and spec["attempts"] == 1 for spec in done_jobs.values())
+
+
+def test_restarted_worker_releases_its_claims(tmp_path):
+	queue_dir = make_queue(tmp_path, 2)
+	assert len(claim_jobs(queue_dir, "worker0", 2)) == 2
+	release_jobs(queue_dir, "worker0")
+	assert [job_name for job_name, spec in claim_jobs(queue_dir, "worker1", 2)] == ["00000000", "00000001"]
+
+
+def test_worker_dying_mid_batch_does_not_block_the_queue(tmp_path):
+	queue_dir = make_queue(tmp_path, 4)
+
+	#worker0 claims a batch of 3 jobs, finishes one and dies
+	jobs = claim_jobs(queue_dir, "worker0", 3)
+	complete_job(queue_dir, "worker0", *jobs[0], True)
+
+	#the other worker runs the last job but cannot finish while worker0's claims are held
+	assert not drain(queue_dir, "worker1", timeout=0.2)
+	assert not is_drained(queue_dir)
+
+	#once the driver sees worker0 has stopped it fails the jobs worker0 still had claimed
+	assert fail_jobs(queue_dir, "worker0", error="worker stopped") == [jobs[1][0], jobs[2][0]]
+	assert is_drained(queue_dir)
+	assert drain(queue_dir, "worker1")
+
+	done_jobs = get_done_jobs(queue_dir)
+	assert len(done_jobs) == 4
+	assert [job_name for job_name, spec in done_jobs.items() if not spec["succeeded"]] == [jobs[1][0], jobs[2][0]]
+	assert done_jobs[jobs[1][0]]["error"] == "worker stopped"
+	assert fail_jobs(queue_dir, "worker0") == []
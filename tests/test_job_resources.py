@@ -0,0 +1,29 @@
+import os
+import signal
+
+from job_resources import parse_memory_size, get_job_resources, get_docker_call, is_killed, is_oom_exit
+
+
+def test_job_memory_is_heap_plus_overhead():
+	assert parse_memory_size("4g") == 4 * 2**30
+	assert parse_memory_size("512M") == 512 * 2**20
+	assert get_job_resources("4g", 1536) == {"num_cpus": 1, "memory": 4 * 2**30 + 1536 * 2**20}
+
+
+def test_docker_call_is_limited_to_the_job_memory():
+	memory = get_job_resources("4g", 1536)["memory"]
+	call = get_docker_call("exomiser-pipeline:test", "--rm -e exomiser_Xmx=4g", "python3.8 run_exomiser_job.py > out", memory)
+	assert call == "docker run --memory={0} --memory-swap={0} --rm -e exomiser_Xmx=4g exomiser-pipeline:test python3.8 run_exomiser_job.py > out".format(memory)
+	assert call.split()[2] == "--memory=5905580032"
+
+
+def test_oom_kills_are_recognised():
+	#os.system status of a shell whose child was killed (128 + SIGKILL), and of a process killed directly
+	assert is_oom_exit(137 << 8)
+	assert is_killed(137 << 8)
+	assert is_killed(signal.SIGKILL)
+	assert not is_oom_exit(1 << 8)
+	assert not is_killed(1 << 8)
+	assert not is_killed(0)
+	#a real shell reports a child killed by SIGKILL with exit status 137
+	assert is_killed(os.system("sh -c 'kill -9 $$'"))
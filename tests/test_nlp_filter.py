@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import nlp_filter
+from nlp_filter import sweep_NLP, sweep_NLP_incremental, get_output_filename, get_bitmask_filename, materialize_bitmask_run
+
+
+runs = {
+	"NLP": [0, 0, 100, 100],
+	"NLP_fp50": [50, 0, 100, 100],
+	"NLP_fp90_c2": [90, 0, 100, 2],
+	"NLP_c1_d3": [0, 3, 100, 1],
+	"NLP_fp40_c3_d2_D6": [40, 2, 6, 3],
+}
+
+
+#small HPO depth/clade tables (some terms without depth or clades) and their hp#######_Term criteria
+def write_hpo_tables(rng, n_terms=40):
+	hpo_ids = ["HP:{:07d}".format(x) for x in range(1, n_terms + 1)]
+	min_path_length = rng.integers(1, 10, n_terms).astype(float)
+	min_path_length[::11] = np.nan
+	stats = pd.DataFrame({"HPO_ID": hpo_ids, "min_path_length": min_path_length, "max_path_length": min_path_length + 1, "root_phenos": "[]"})
+	stats.drop(index=range(3, n_terms, 13)).to_csv(nlp_filter.clade_depth_file, index=False)
+	clades = pd.DataFrame({"HPO_ID": np.repeat(hpo_ids, rng.integers(1, 4, n_terms)), "root_phenos": None})
+	clades["root_phenos"] = ["HP:99000{:02d}".format(x) for x in rng.integers(0, 5, len(clades))]
+	clades.drop_duplicates().loc[lambda x: x.HPO_ID != hpo_ids[5], :].to_csv(nlp_filter.clades_list_file, index=False)
+	return(["hp{:07d}_Term_{}".format(x, x) for x in range(1, n_terms + 1)])
+
+
+def make_patient_terms(rng, criteria):
+	patient_criteria = rng.choice(criteria, rng.integers(3, 20), replace=False)
+	return([(criterion, int(frequency)) for criterion, frequency in zip(patient_criteria, rng.choice([1, 1, 2, 3, 5, 8, 16], len(patient_criteria)))])
+
+
+def write_terms(patients, input_filename):
+	with open(input_filename, "w") as fhw:
+		for patient, terms in patients.items():
+			fhw.write("{}\nCriterion,Frequency\n".format(patient))
+			for criterion, frequency in terms:
+				fhw.write("{},{}\n".format(criterion, frequency))
+
+
+#filter_NLP as originally written (one parameter combination, row by row in pandas), the reference for the sweep
+def reference_filter_NLP(input_filename, min_freq, min_depth, max_depth, num_clades, output_path, min_terms=5):
+	data = []
+	with open(input_filename) as fh:
+		for line in fh:
+			line = line.strip().split(",")
+			if len(line) == 1:
+				key = line[0]
+			elif line[0] != "Criterion":
+				data.append([key, line[0], int(line[1])])
+	data = pd.DataFrame(data, columns=["Patient", "Criterion", "Frequency"])
+
+	data["percentile"] = data.groupby("Patient").Frequency.transform(lambda x: x.rank() / len(x))
+	data.loc[:, "HPO_ID"] = data["Criterion"].apply(lambda x: x.split("_")[0].replace("hp", "HP:"))
+	data = data.join(pd.read_csv(nlp_filter.clade_depth_file).set_index("HPO_ID"), how="left", on="HPO_ID")
+
+	data_to_keep = data.loc[data["percentile"] >= (min_freq / 100), :].copy()
+	data_to_keep = data_to_keep.loc[((data_to_keep.min_path_length.notna()) & (data_to_keep.min_path_length >= min_depth) & (data_to_keep.min_path_length <= max_depth)) | data_to_keep["min_path_length"].isna(), :]
+	data_to_keep = data_to_keep.join(pd.read_csv(nlp_filter.clades_list_file).set_index("HPO_ID"), how="left", on="HPO_ID", lsuffix="", rsuffix="_2")
+	data_to_keep.loc[data_to_keep.root_phenos_2.isna(), "root_phenos_2"] = "unknown"
+	data_to_keep["clade_frequency"] = data_to_keep.groupby(["Patient", "root_phenos_2"]).percentile.transform(lambda x: x.mean())
+	data_to_keep["clade_frequency_rank"] = data_to_keep.groupby(["Patient"]).clade_frequency.transform(lambda x: x.rank(ascending=False, method="dense"))
+	data_to_keep = data_to_keep.loc[((data_to_keep.root_phenos_2 != "unknown") & (data_to_keep.clade_frequency_rank <= num_clades)) | data_to_keep.root_phenos_2.eq("unknown"), :]
+	data_to_keep = data_to_keep[["Patient", "Criterion", "Frequency"]].drop_duplicates()
+
+	data = data[["Patient", "Criterion", "Frequency"]].drop_duplicates()
+	patient_term_counts = data_to_keep.groupby("Patient").Patient.count()
+	patients_to_reset = set(data.Patient) - set(data_to_keep.Patient) | set(patient_term_counts[patient_term_counts <= min_terms].index)
+	data_to_keep = pd.concat([data_to_keep.loc[~data_to_keep.Patient.isin(patients_to_reset), :], data.loc[data.Patient.isin(patients_to_reset), :]])
+
+	with open(output_path, "w") as fhw:
+		for name, group in data_to_keep.groupby("Patient"):
+			fhw.write("{}\nCriterion,Frequency\n".format(name))
+			for ind, row in group.iterrows():
+				fhw.write("{},{}\n".format(row.Criterion, row.Frequency))
+
+
+def read_text(path):
+	with open(path) as fh:
+		return(fh.read())
+
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+	#the HPO tables and their index are read from the working directory
+	monkeypatch.chdir(tmp_path)
+	rng = np.random.default_rng(0)
+	criteria = write_hpo_tables(rng)
+	return(rng, criteria, {"patient{:02d}".format(i): make_patient_terms(rng, criteria) for i in range(12)})
+
+
+#full sweep of the same input into its own directory, the expected outputs of an incremental refresh
+def full_sweep_outputs(input_filename, output_dir):
+	os.makedirs(output_dir)
+	output_file_map = sweep_NLP(input_filename, runs, output_dir)
+	return({runName: read_text(os.path.join(output_dir, output_filename)) for runName, output_filename in output_file_map.items()})
+
+
+def incremental_outputs(output_file_map, output_dir):
+	return({runName: read_text(os.path.join(output_dir, output_filename)) for runName, output_filename in output_file_map.items()})
+
+
+def update_cohort(rng, criteria, patients):
+	patients = dict(patients)
+	del patients["patient03"]
+	patients["patient07"] = make_patient_terms(rng, criteria)
+	patients["patient12"] = make_patient_terms(rng, criteria)
+	return(patients)
+
+
+def test_sweep_matches_filter_NLP(cohort):
+	rng, criteria, patients = cohort
+	write_terms(patients, "terms.txt")
+	os.makedirs("sweep")
+	os.makedirs("reference")
+	output_file_map = sweep_NLP("terms.txt", runs, "sweep", output_format=["text", "bitmask"])
+	for runName, params in runs.items():
+		output_filename = get_output_filename("UnDx_NLPoutput", *params)
+		assert output_file_map[runName] == output_filename
+		reference_filter_NLP("terms.txt", *params, os.path.join("reference", output_filename))
+		assert read_text(os.path.join("sweep", output_filename)) == read_text(os.path.join("reference", output_filename))
+
+		materialize_bitmask_run(os.path.join("sweep", get_bitmask_filename("UnDx_NLPoutput")), output_filename, "reference")
+		assert read_text(os.path.join("sweep", output_filename)) == read_text(os.path.join("reference", output_filename))
+
+
+def test_incremental_refresh_matches_full_sweep(cohort):
+	rng, criteria, patients = cohort
+	write_terms(patients, "terms.txt")
+	os.makedirs("incremental")
+	output_file_map = sweep_NLP_incremental("terms.txt", runs, "shards", "incremental")
+	assert incremental_outputs(output_file_map, "incremental") == full_sweep_outputs("terms.txt", "full1")
+
+	#patient03 is removed, patient07 is changed and patient12 is added
+	write_terms(update_cohort(rng, criteria, patients), "terms.txt")
+	output_file_map = sweep_NLP_incremental("terms.txt", runs, "shards", "incremental")
+	assert incremental_outputs(output_file_map, "incremental") == full_sweep_outputs("terms.txt", "full2")
+	assert len(os.listdir("shards")) == 3
+
+
+def test_interrupted_refresh_is_redone(cohort, monkeypatch):
+	rng, criteria, patients = cohort
+	write_terms(patients, "terms.txt")
+	os.makedirs("incremental")
+	output_file_map = sweep_NLP_incremental("terms.txt", runs, "shards", "incremental")
+
+	#the refresh stops after its new shard is written, before the first output is replaced
+	write_terms(update_cohort(rng, criteria, patients), "terms.txt")
+	def interrupt(*args, **kwargs):
+		raise KeyboardInterrupt()
+	with monkeypatch.context() as m:
+		m.setattr(nlp_filter, "write_patient_blocks", interrupt)
+		with pytest.raises(KeyboardInterrupt):
+			sweep_NLP_incremental("terms.txt", runs, "shards", "incremental")
+
+	output_file_map = sweep_NLP_incremental("terms.txt", runs, "shards", "incremental")
+	assert incremental_outputs(output_file_map, "incremental") == full_sweep_outputs("terms.txt", "full")
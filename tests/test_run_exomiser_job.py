@@ -0,0 +1,53 @@
+import yaml
+
+from run_exomiser_job import get_prefilter_analysis, get_object_md5
+
+
+base_yml = """
+analysis:
+  genomeAssembly: hg19
+  vcf: null
+  hpoIds: ['HP:0001156']
+  analysisMode: PASS_ONLY
+  steps: [
+    variantEffectFilter: {remove: [SYNONYMOUS_VARIANT]},
+    frequencyFilter: {maxFrequency: 2.0},
+    pathogenicityFilter: {keepNonPathogenic: true},
+    inheritanceFilter: {},
+    omimPrioritiser: {},
+    hiPhivePrioritiser: {}
+  ]
+outputOptions:
+  outputContributingVariantsOnly: true
+  numGenes: 20
+  minExomiserGeneScore: 0.7
+  outputPrefix: results/Pfeiffer
+  outputFormats: [HTML, JSON]
+"""
+
+
+def test_prefilter_analysis_keeps_only_variant_filters():
+	data = get_prefilter_analysis(yaml.safe_load(base_yml), "/data/Pfeiffer.vcf", "/results/Pfeiffer")
+	assert [list(step)[0] for step in data["analysis"]["steps"]] == ["variantEffectFilter", "frequencyFilter", "pathogenicityFilter"]
+	assert data["analysis"]["vcf"] == "/data/Pfeiffer.vcf"
+	assert data["analysis"]["hpoIds"] == []
+	assert data["outputOptions"]["outputPrefix"] == "/results/Pfeiffer"
+	assert data["outputOptions"]["outputFormats"] == ["TSV_VARIANT"]
+
+
+def test_prefilter_analysis_lifts_output_limits():
+	#a base analysis reporting the top numGenes genes would leave the passing variants of the other genes out of the prefiltered VCF
+	data = get_prefilter_analysis(yaml.safe_load(base_yml), "/data/Pfeiffer.vcf", "/results/Pfeiffer")
+	assert data["outputOptions"]["numGenes"] == 0
+	assert data["outputOptions"]["outputContributingVariantsOnly"] is False
+	assert "minExomiserGeneScore" not in data["outputOptions"]
+
+
+def test_object_md5_is_only_taken_from_plain_etags():
+	etag = '"{}"'.format("0" * 32)
+	assert get_object_md5({"ETag": etag, "ContentLength": 10}) == "0" * 32
+	assert get_object_md5({"ETag": '"{}-3"'.format("0" * 32), "ContentLength": 10}) is None
+	#the ETag of an SSE-KMS or SSE-C object is not its md5
+	assert get_object_md5({"ETag": etag, "ContentLength": 10, "ServerSideEncryption": "aws:kms"}) is None
+	assert get_object_md5({"ETag": etag, "ContentLength": 10, "ServerSideEncryption": "AES256", "SSECustomerAlgorithm": "AES256"}) is None
+	assert get_object_md5({"ETag": etag, "ContentLength": 10, "ServerSideEncryption": "aws:kms", "Metadata": {"md5": "1" * 32}}) == "1" * 32